@@ -0,0 +1,62 @@
+"""
+Measure how DNABERT pre-training throughput scales with the number of local data-parallel worker
+processes.
+
+A fresh model is trained for a few short epochs with 1, 2, ... up to --max-workers workers, each
+with an equal share of the CPUs. Speedup is relative to a single worker and efficiency is the
+speedup per worker. The marginal gain is the throughput added by the last worker, so the point
+where adding workers stops paying off shows up as a gain near (or below) zero.
+
+Usage:
+    python benchmarks/distributed.py SEQUENCES_DB.qza [--max-workers 4] [--batch-size 256] [--epochs 3]
+"""
+import argparse
+from dnadb import fasta
+import qiime2
+
+from q2_deepdna import models
+from q2_deepdna._distribute import fit_distributed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sequences", help="A FeatureData[SequenceDB] artifact.")
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--sequence-length", type=int, default=150)
+    parser.add_argument("--kmer", type=int, default=3)
+    parser.add_argument("--embed-dim", type=int, default=64)
+    parser.add_argument("--stack", type=int, default=8)
+    parser.add_argument("--num-heads", type=int, default=8)
+    args = parser.parse_args()
+    sequences = qiime2.Artifact.load(args.sequences).view(fasta.FastaDb)
+    fit_kwargs = dict(
+        epochs=args.epochs,
+        steps_per_epoch=args.steps,
+        mask_ratio=0.15,
+        batch_size=args.batch_size,
+        val_batch_size=args.batch_size,
+        val_frequency=args.epochs,
+        val_steps=1,
+        verbose=0)
+    print("| Workers | Sequences/s | Speedup | Efficiency | Marginal gain (seq/s) |")
+    print("| --- | --- | --- | --- | --- |")
+    baseline = previous = None
+    for workers in range(1, args.max_workers + 1):
+        if args.batch_size % workers != 0:
+            print(f"| {workers} | skipped: batch size not divisible | | | |")
+            continue
+        container = models.DNABERTPretrainingModel.create(
+            args.sequence_length, args.kmer, args.embed_dim, args.stack, args.num_heads)
+        history = fit_distributed(container, workers, str(sequences.path), None, fit_kwargs, {"mode": "disabled"})
+        rate = history.sequences / history.wall_time
+        baseline = baseline or rate
+        gain = f"{rate - previous:.1f}" if previous is not None else "-"
+        previous = rate
+        print(f"| {workers} | {rate:.1f} | {rate / baseline:.2f}x | {rate / baseline / workers:.0%} | {gain} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare default Keras execution against the XLA-compiled, fixed-shape mode for saved models.
+
+Inference is timed for every model. The masked-language-model training step is also timed for
+DNABERT pre-training models. The number of sets/sequences is deliberately not a multiple of the
+batch size, so the default mode also pays for retracing on the odd final batch.
+
+Usage:
+    python benchmarks/jit_compile.py MODEL.qza [MODEL.qza ...] [--batch-size 16] [--num-inputs 250]
+"""
+import argparse
+import numpy as np
+import qiime2
+import tensorflow as tf
+import time
+
+from q2_deepdna import models
+from q2_deepdna._compile import enable_jit_compile, pad_to_batches
+from q2_deepdna._profile import tracing_counts
+
+VIEWS = {
+    "DNABERTPretrainingModel": models.DNABERTPretrainingModel,
+    "DNABERTNaiveTaxonomyModel": models.DNABERTNaiveTaxonomyModel,
+    "DNABERTBERTaxTaxonomyModel": models.DNABERTBERTaxTaxonomyModel,
+    "DNABERTTopDownTaxonomyModel": models.DNABERTTopDownTaxonomyModel,
+    "SetBERTTaxonomyModel": models.SetBERTTaxonomyModel,
+}
+
+
+def load(path):
+    artifact = qiime2.Artifact.load(path)
+    name = str(artifact.type.fields[0])
+    container = artifact.view(VIEWS[name])
+    if container.model is None:
+        raise ValueError(f"{path} is a quantized model without a float Keras model to benchmark.")
+    return name, container
+
+
+def random_inputs(model: tf.keras.Model, n: int, seed: int = 0) -> np.ndarray:
+    # Token 0-3 is a valid k-mer for any k, which is all a timing run needs
+    shape = tuple(dim for dim in model.input_shape[1:])
+    return np.random.default_rng(seed).integers(0, 4, (n,) + shape).astype(np.int32)
+
+
+def time_predict(model: tf.keras.Model, x: np.ndarray, batch_size: int, jit_compile: bool, repeats: int):
+    if jit_compile:
+        enable_jit_compile(model)
+        x = pad_to_batches(x, batch_size)
+    model.predict(x, batch_size=batch_size, verbose=0) # trace/compile
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(x, batch_size=batch_size, verbose=0)
+    return (time.perf_counter() - start) / repeats
+
+
+def time_train(model: tf.keras.Model, x: np.ndarray, batch_size: int, jit_compile: bool, repeats: int):
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-4), jit_compile=jit_compile)
+    batch = x[:batch_size]
+    model.train_on_batch(batch, batch) # trace/compile
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.train_on_batch(batch, batch)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("models", nargs="+", help="DeepDNA model artifacts to benchmark.")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-inputs", type=int, default=250)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    print("| Model | Step | Default (s) | XLA (s) | Speedup | Traces (default/XLA) |")
+    print("| --- | --- | --- | --- | --- | --- |")
+    for path in args.models:
+        name, container = load(path)
+        x = random_inputs(container.model, args.num_inputs)
+        steps = [("predict", time_predict)]
+        if isinstance(container, models.DNABERTPretrainingModel):
+            steps.append(("train", time_train))
+        for step, benchmark in steps:
+            results = []
+            for jit_compile in (False, True):
+                # Reload so each mode starts from untraced functions
+                _, container = load(path)
+                elapsed = benchmark(container.model, x, args.batch_size, jit_compile, args.repeats)
+                traces = sum(tracing_counts(container.model).values())
+                results.append((elapsed, traces))
+            (default, default_traces), (xla, xla_traces) = results
+            print(f"| {name} | {step} | {default:.4f} | {xla:.4f} | {default / xla:.2f}x | {default_traces}/{xla_traces} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare float32 against mixed_bfloat16 execution for saved models.
+
+Inference throughput is measured for every model, and training-step throughput is also measured
+for DNABERT pre-training models. Accuracy is compared on the models' raw outputs for the same
+inputs: the fraction of top-1 predictions that agree with float32, and the mean absolute
+deviation from the float32 outputs.
+
+Usage:
+    python benchmarks/precision.py MODEL.qza [MODEL.qza ...] [--batch-size 16] [--num-inputs 256]
+"""
+import argparse
+import numpy as np
+import tensorflow as tf
+import time
+
+from q2_deepdna import models
+from q2_deepdna._precision import cast_model
+
+from jit_compile import load, random_inputs
+
+
+def throughput(step, n: int, repeats: int) -> float:
+    step() # trace
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    return n * repeats / (time.perf_counter() - start)
+
+
+def predict_step(model: tf.keras.Model, x: np.ndarray, batch_size: int):
+    return lambda: model.predict(x, batch_size=batch_size, verbose=0)
+
+
+def train_step(model: tf.keras.Model, x: np.ndarray, batch_size: int):
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-4))
+    batch = x[:batch_size]
+    return lambda: model.train_on_batch(batch, batch)
+
+
+def outputs(model: tf.keras.Model, x: np.ndarray, batch_size: int) -> list:
+    batches = [tf.nest.flatten(model(x[i:i+batch_size], training=False)) for i in range(0, len(x), batch_size)]
+    return [np.concatenate([tf.cast(b[k], tf.float32).numpy() for b in batches]) for k in range(len(batches[0]))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("models", nargs="+", help="DeepDNA model artifacts to benchmark.")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-inputs", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    print("| Model | Step | float32 (inputs/s) | mixed_bfloat16 (inputs/s) | Speedup | Top-1 agreement | Mean abs deviation |")
+    print("| --- | --- | --- | --- | --- | --- | --- |")
+    for path in args.models:
+        name, container = load(path)
+        x = random_inputs(container.model, args.num_inputs)
+        reference = cast_model(container.model, "float32")
+        mixed = cast_model(reference, "mixed_bfloat16")
+        expected, actual = outputs(reference, x, args.batch_size), outputs(mixed, x, args.batch_size)
+        agreement = np.mean([np.mean(e.argmax(-1) == a.argmax(-1)) for e, a in zip(expected, actual)])
+        deviation = np.mean([np.mean(np.abs(e - a)) for e, a in zip(expected, actual)])
+        steps = [("predict", predict_step, args.num_inputs)]
+        if isinstance(container, models.DNABERTPretrainingModel):
+            steps.append(("train", train_step, args.batch_size))
+        for step, make_step, n in steps:
+            rates = [throughput(make_step(model, x, args.batch_size), n, args.repeats) for model in (reference, mixed)]
+            print(
+                f"| {name} | {step} | {rates[0]:.1f} | {rates[1]:.1f} | {rates[1] / rates[0]:.2f}x "
+                f"| {agreement:.2%} | {deviation:.2e} |")
+
+
+if __name__ == "__main__":
+    main()
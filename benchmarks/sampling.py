@@ -0,0 +1,59 @@
+"""
+Compare the throughput of the pre-training sampling modes on a sequence DB: random entry lookups
+(the default), block-sequential cursor reads through a shuffle buffer, and, optionally,
+pre-encoded sequences.
+
+Run it against a DB on the storage you train from. Drop the page cache between runs (or use a DB
+larger than memory) to measure cold reads. The block mode's time includes filling its buffer.
+
+Usage:
+    python benchmarks/sampling.py SEQUENCES_DB.qza [--encoded ENCODED.qza] [--batch-size 256] [--steps 200]
+"""
+import argparse
+from dnadb import fasta
+import qiime2
+import time
+
+from q2_deepdna import models
+from q2_deepdna._encoded import EncodedSequences
+
+
+def throughput(batches, steps: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    for i in range(steps):
+        batches[i]
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sequences", help="A FeatureData[SequenceDB] artifact.")
+    parser.add_argument("--encoded", help="The same sequences as a FeatureData[EncodedSequences] artifact.")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--sequence-length", type=int, default=150)
+    parser.add_argument("--kmer", type=int, default=3)
+    parser.add_argument("--buffer-size", type=int, default=100_000)
+    parser.add_argument("--block-size", type=int, default=1024)
+    args = parser.parse_args()
+    sequences = qiime2.Artifact.load(args.sequences).view(fasta.FastaDb)
+    shape = (args.batch_size, args.steps, args.sequence_length, args.kmer)
+    modes = [
+        ("random", models._sequence_batches(sequences, *shape)),
+        ("block", models.BlockSequenceBatches(
+            sequences, *shape, buffer_size=args.buffer_size, block_size=args.block_size)),
+    ]
+    if args.encoded is not None:
+        encoded = qiime2.Artifact.load(args.encoded).view(EncodedSequences)
+        modes.append((f"encoded ({encoded.packing})", models.EncodedSequenceBatches(encoded, *shape)))
+    print("| Sampling | Sequences/s | Relative |")
+    print("| --- | --- | --- |")
+    baseline = None
+    for name, batches in modes:
+        rate = throughput(batches, args.steps, args.batch_size)
+        baseline = baseline or rate
+        print(f"| {name} | {rate:.1f} | {rate / baseline:.2f}x |")
+
+
+if __name__ == "__main__":
+    main()
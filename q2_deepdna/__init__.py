@@ -11,3 +11,6 @@ importlib.import_module("q2_deepdna.data")
 importlib.import_module("q2_deepdna.classify")
 importlib.import_module("q2_deepdna.finetune")
 importlib.import_module("q2_deepdna.pretrain")
+importlib.import_module("q2_deepdna.quantize")
+importlib.import_module("q2_deepdna.distill")
+importlib.import_module("q2_deepdna.early_exit")
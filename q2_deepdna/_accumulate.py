@@ -0,0 +1,50 @@
+import tensorflow as tf
+
+# Accumulation is built on the OptimizerV2 API. Later TensorFlow releases keep it under `legacy`
+_Adam = getattr(tf.keras.optimizers, "legacy", tf.keras.optimizers).Adam
+
+
+# Registered so that saved models compiled with it can be loaded again
+@tf.keras.utils.register_keras_serializable(package="q2_deepdna")
+class GradientAccumulatingAdam(_Adam):
+    """
+    Adam that sums the gradients of `accumulation_steps` consecutive micro-batches and applies
+    their mean as a single update. Training on micro-batches of size B then behaves like training
+    on batches of size B * accumulation_steps, while only one micro-batch is held in memory.
+
+    Accumulation happens in `apply_gradients`, so it works with models that define their own
+    train step. The optimizer's `iterations` only advance on actual updates. Only use it with
+    `accumulation_steps > 1`; plain Adam is enough otherwise.
+    """
+    def __init__(self, accumulation_steps: int = 2, **kwargs):
+        super().__init__(**kwargs)
+        self.accumulation_steps = accumulation_steps
+        self._micro_steps = None
+
+    def apply_gradients(self, grads_and_vars, name=None, **kwargs):
+        grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+        var_list = [var for _, var in grads_and_vars]
+        with tf.init_scope():
+            # The accumulators are ordinary slots, so they are saved with the rest of the state
+            for var in var_list:
+                self.add_slot(var, "accumulated")
+            if self._micro_steps is None:
+                self._micro_steps = self.add_weight("micro_steps", shape=[], dtype=tf.int64, trainable=False)
+        for grad, var in grads_and_vars:
+            self.get_slot(var, "accumulated").assign_add(tf.convert_to_tensor(grad))
+        micro_steps = self._micro_steps.assign_add(1)
+
+        def apply():
+            accumulated = [self.get_slot(var, "accumulated") for var in var_list]
+            super(GradientAccumulatingAdam, self).apply_gradients(
+                [(a / self.accumulation_steps, var) for a, var in zip(accumulated, var_list)], name, **kwargs)
+            for a in accumulated:
+                a.assign(tf.zeros_like(a))
+
+        tf.cond(micro_steps % self.accumulation_steps == 0, apply, lambda: None)
+        return self.iterations
+
+    def get_config(self):
+        config = super().get_config()
+        config["accumulation_steps"] = self.accumulation_steps
+        return config
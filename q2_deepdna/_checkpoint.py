@@ -0,0 +1,105 @@
+import json
+import numpy as np
+import os
+from pathlib import Path
+import tensorflow as tf
+from typing import Any, Dict, List
+
+
+def _rng_state(data) -> Dict[str, Any]:
+    """
+    The state of the random generators (and seed) a batch generator samples with.
+    """
+    state = {}
+    for name, value in vars(data).items():
+        if isinstance(value, np.random.Generator):
+            state[name] = value.bit_generator.state
+        elif name == "seed" and isinstance(value, (int, np.integer)):
+            state[name] = int(value)
+    return state
+
+
+def _set_rng_state(data, state: Dict[str, Any]):
+    for name, value in state.items():
+        if name == "seed":
+            data.seed = value
+        elif isinstance(getattr(data, name, None), np.random.Generator):
+            getattr(data, name).bit_generator.state = value
+
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    """
+    Periodically checkpoints the model weights, optimizer state and epoch counter, along with the
+    state of the batch generators' random number generators, so that training can be resumed
+    where it left off.
+
+    Checkpoints are written asynchronously where TensorFlow supports it (not on TensorFlow 2.9,
+    which saves synchronously).
+    """
+    def __init__(
+        self,
+        directory: str,
+        model: tf.keras.Model,
+        data: List[Any],
+        config: Dict[str, Any],
+        frequency: int = 1,
+        max_to_keep: int = 3
+    ):
+        super().__init__()
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.data = data
+        self.config = config
+        self.frequency = frequency
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer, epoch=self.epoch)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, str(self.directory), max_to_keep=max_to_keep)
+        try:
+            self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        except TypeError:
+            self.options = tf.train.CheckpointOptions()
+
+    def restore(self) -> int:
+        """
+        Restore the latest checkpoint, if any, returning the epoch to resume training from.
+        """
+        config_path = self.directory / "config.json"
+        if config_path.exists():
+            with open(config_path) as f:
+                config = json.load(f)
+            if config != json.loads(json.dumps(self.config, default=str)):
+                raise ValueError(
+                    f"The checkpoints in {self.directory} were written by a run with a different "
+                    "configuration. Use a new checkpoint directory.")
+        else:
+            with open(config_path, "w") as f:
+                json.dump(self.config, f, default=str)
+        latest = self.manager.latest_checkpoint
+        if latest is None:
+            return 0
+        self.checkpoint.restore(latest)
+        epoch = int(self.epoch.numpy())
+        with open(self.directory / f"rng-{epoch}.json") as f:
+            states = json.load(f)
+        for data, state in zip(self.data, states):
+            _set_rng_state(data, state)
+            # The checkpoint was taken before the generator advanced to the next epoch
+            data.on_epoch_end()
+        return epoch
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.frequency != 0:
+            return
+        self.epoch.assign(epoch + 1)
+        with open(self.directory / f"rng-{epoch + 1}.json", "w") as f:
+            json.dump([_rng_state(data) for data in self.data], f)
+        self.manager.save(checkpoint_number=epoch + 1, options=self.options)
+        # Drop the generator states of checkpoints the manager has deleted
+        kept = {os.path.basename(path) for path in self.manager.checkpoints}
+        for path in self.directory.glob("rng-*.json"):
+            if f"ckpt-{path.stem[4:]}" not in kept:
+                path.unlink()
+
+    def on_train_end(self, logs=None):
+        if hasattr(self.checkpoint, "sync"):
+            self.checkpoint.sync()
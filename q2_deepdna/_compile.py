@@ -0,0 +1,25 @@
+import numpy as np
+import tensorflow as tf
+
+
+def enable_jit_compile(model: tf.keras.Model):
+    """
+    Compile the model's Keras train/test/predict steps with XLA. Any cached step functions are
+    discarded so that the next call traces them with the new setting.
+    """
+    model.jit_compile = True
+    model.train_function = None
+    model.test_function = None
+    model.predict_function = None
+
+
+def pad_to_batches(x: np.ndarray, batch_size: int) -> np.ndarray:
+    """
+    Pad the leading dimension to a multiple of the batch size by repeating the final element so
+    that every batch has the same shape and reuses the same compiled graph.
+    """
+    remainder = len(x) % batch_size
+    if remainder == 0:
+        return x
+    padding = np.repeat(x[-1:], batch_size - remainder, axis=0)
+    return np.concatenate([x, padding])
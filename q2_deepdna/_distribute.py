@@ -0,0 +1,128 @@
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import socket
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+
+def _free_ports(n: int) -> List[int]:
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def _cpu_slices(n: int) -> List[List[int]]:
+    """
+    Split the CPUs available to this process into contiguous slices, one per worker. Contiguous
+    CPU numbers usually share a socket, which keeps each worker's threads on its own socket.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    size = max(len(cpus) // n, 1)
+    return [cpus[i*size:(i+1)*size] or cpus for i in range(n)]
+
+
+def _worker(index: int, num_workers: int, ports: List[int], cpus: List[int], spec: Dict[str, Any], directory: str):
+    """
+    Train one replica of a DNABERT pre-training model. Runs in a freshly spawned process, since a
+    multi-worker strategy must be created before TensorFlow executes anything.
+    """
+    os.environ["TF_CONFIG"] = json.dumps({
+        "cluster": {"worker": [f"localhost:{port}" for port in ports]},
+        "task": {"type": "worker", "index": index}
+    })
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+    from dnadb import fasta
+    import wandb
+    from ._encoded import EncodedSequences
+    from ._weights import read_weights, write_weights
+    from .models import DNABERTPretrainingModel
+
+    chief = index == 0
+    # Only the chief reports to wandb
+    wandb.init(**(spec["wandb"] if chief else {"mode": "disabled"}))
+    with strategy.scope():
+        container = DNABERTPretrainingModel.create(**spec["model"])
+        container.model.set_weights([w.copy() for w in read_weights(Path(directory) / "initial")])
+    sequences = fasta.FastaDb(spec["sequences"])
+    encoded = EncodedSequences(spec["encoded_sequences"]) if spec["encoded_sequences"] else None
+    start = time.perf_counter()
+    history = container.fit(
+        sequences,
+        val_sequences=None,
+        encoded_sequences=encoded,
+        **{**spec["fit"], "verbose": spec["fit"]["verbose"] if chief else 0})
+    wall_time = time.perf_counter() - start
+    # Every optimizer update consumes one global batch across the replicas
+    trained = int(container.model.optimizer.iterations.numpy()) * spec["fit"]["batch_size"]
+    if chief:
+        write_weights(Path(directory) / "trained", [w.numpy() for w in container.model.weights])
+        with open(Path(directory) / "result.json", "w") as f:
+            json.dump({
+                "config": container.manifest.config,
+                "epoch": history.epoch,
+                "history": {k: [float(v) for v in values] for k, values in history.history.items()},
+                "sequences": trained,
+                "wall_time": wall_time
+            }, f, default=str)
+    wandb.finish()
+
+
+def fit_distributed(
+    container,
+    num_workers: int,
+    sequences_path: str,
+    encoded_sequences_path: Optional[str],
+    fit_kwargs: Dict[str, Any],
+    wandb_kwargs: Dict[str, Any]
+):
+    """
+    Train a DNABERT pre-training model data-parallel across local worker processes with a
+    multi-worker mirrored strategy, updating the container with the trained weights and training
+    configuration. Returns the chief worker's training history, annotated with the number of
+    sequences trained on and the wall time.
+    """
+    import tensorflow as tf
+    from ._weights import read_weights, write_weights
+    with tempfile.TemporaryDirectory() as directory:
+        write_weights(Path(directory) / "initial", [w.numpy() for w in container.model.weights])
+        spec = {
+            "model": container.manifest.config["model"],
+            "sequences": sequences_path,
+            "encoded_sequences": encoded_sequences_path,
+            "fit": fit_kwargs,
+            "wandb": wandb_kwargs
+        }
+        ports = _free_ports(num_workers)
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=_worker, args=(i, num_workers, ports, cpus, spec, directory))
+            for i, cpus in enumerate(_cpu_slices(num_workers))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Training workers {failed} exited with an error.")
+        container.model.set_weights([w.copy() for w in read_weights(Path(directory) / "trained")])
+        with open(Path(directory) / "result.json") as f:
+            result = json.load(f)
+    container.manifest.config = result["config"]
+    history = tf.keras.callbacks.History()
+    history.epoch = result["epoch"]
+    history.history = result["history"]
+    history.sequences = result["sequences"]
+    history.wall_time = result["wall_time"]
+    return history
@@ -0,0 +1,126 @@
+"""
+Bulk writers for dnadb databases.
+
+dnadb's factories encode and write one entry at a time. The writers here write the same LMDB keys
+directly for entries that were already parsed or resolved in bulk. The key layout is mirrored from
+dnadb 0.14.2 and is unchanged since 0.12.0. With any other dnadb release, the writers fall back to
+the factories' own methods, which are slower but always match the installed layout.
+"""
+from dnadb import fasta, taxonomy
+from dnadb.db import DbFactory
+import functools
+import importlib.metadata
+import numpy as np
+from pathlib import Path
+from typing import Iterable, List, Tuple, Union
+
+# The dnadb releases whose key layout is mirrored below (verified against 0.12.0 to 0.14.2)
+MIRRORED_VERSIONS = ("0.12", "0.13", "0.14")
+
+
+@functools.lru_cache(maxsize=None)
+def mirrors_layout() -> bool:
+    """
+    Whether the installed dnadb release uses the key layout mirrored here.
+    """
+    try:
+        version = importlib.metadata.version("dnadb")
+    except importlib.metadata.PackageNotFoundError:
+        return False
+    return ".".join(version.split(".")[:2]) in MIRRORED_VERSIONS
+
+
+def write_fasta_entries(factory: fasta.FastaDbFactory, entries: Iterable[Tuple[str, bytes]]):
+    """
+    Write (identifier, serialized entry) pairs as FastaDbFactory.write_entry writes parsed entries.
+    """
+    if not mirrors_layout():
+        factory.write_entries(fasta.FastaEntry.deserialize(serialized) for _, serialized in entries)
+        return
+    for identifier, serialized in entries:
+        factory.write(f"id_{identifier}", np.int32(factory.num_entries).tobytes())
+        factory.write(str(factory.num_entries), serialized)
+        factory.num_entries += 1
+
+
+def sequence_indices(sequences_db: fasta.FastaDb, sequence_ids: List[str]) -> np.ndarray:
+    """
+    Look up the indices of many sequence IDs, in a single read transaction where possible.
+    """
+    if not mirrors_layout():
+        missing = [sequence_id for sequence_id in sequence_ids if not sequences_db.contains_sequence_id(sequence_id)]
+        if len(missing) > 0:
+            raise KeyError(f"{len(missing)} sequence IDs are not in the sequences DB, e.g. {missing[:5]}")
+        return np.array([sequences_db.sequence_id_to_index(sequence_id) for sequence_id in sequence_ids], dtype=np.int32)
+    keys = [f"id_{sequence_id}".encode() for sequence_id in sequence_ids]
+    with sequences_db.db.env.begin() as txn:
+        found = dict(txn.cursor().getmulti(keys))
+    missing = [sequence_id for sequence_id, key in zip(sequence_ids, keys) if key not in found]
+    if len(missing) > 0:
+        raise KeyError(f"{len(missing)} sequence IDs are not in the sequences DB, e.g. {missing[:5]}")
+    return np.frombuffer(b"".join(found[key][:4] for key in keys), dtype=np.int32)
+
+
+class TaxonomyDbWriter:
+    """
+    Writes a taxonomy DB as TaxonomyDbFactory does, from chunks of sequences whose indices and
+    taxonomy IDs were resolved in bulk. Only the taxonomy IDs and indices are kept in memory until
+    the DB is closed, rather than the factory's per-label Python lists.
+    """
+    def __init__(
+        self,
+        path: Union[str, Path],
+        sequences_db: fasta.FastaDb,
+        tree: taxonomy.TaxonomyTree,
+        chunk_size: int
+    ):
+        self.sequences_db = sequences_db
+        self.tree = tree
+        self.mirrored = mirrors_layout()
+        if self.mirrored:
+            self.factory = DbFactory(path, chunk_size=chunk_size)
+        else:
+            # The factory builds the same tree from the labels it is given
+            self.factory = taxonomy.TaxonomyDbFactory(path, sequences_db, depth=tree.depth)
+        self.taxonomy_ids: List[np.ndarray] = []
+        self.sequence_indices: List[np.ndarray] = []
+
+    def write_sequences(
+        self,
+        sequence_ids: List[str],
+        labels: List[str],
+        sequence_indices: np.ndarray,
+        taxonomy_ids: np.ndarray
+    ):
+        if not self.mirrored:
+            for sequence_id, label in zip(sequence_ids, labels):
+                self.factory.write_sequence(sequence_id, label)
+            return
+        for sequence_id, sequence_index, taxonomy_id in zip(sequence_ids, sequence_indices.tolist(), taxonomy_ids.tolist()):
+            self.factory.write(str(sequence_index), np.int32(taxonomy_id).tobytes())
+            self.factory.write(f"sequence_index_{sequence_index}", sequence_id.encode())
+            self.factory.write(f"sequence_{sequence_id}", np.int32(sequence_index).tobytes())
+        self.taxonomy_ids.append(taxonomy_ids)
+        self.sequence_indices.append(sequence_indices)
+
+    def close(self):
+        if self.mirrored:
+            taxonomy_ids = np.concatenate(self.taxonomy_ids) if self.taxonomy_ids else np.empty(0, dtype=np.int32)
+            sequence_indices = np.concatenate(self.sequence_indices) if self.sequence_indices else np.empty(0, dtype=np.int32)
+            order = np.lexsort((sequence_indices, taxonomy_ids))
+            taxonomy_ids, sequence_indices = taxonomy_ids[order], sequence_indices[order]
+            unique_ids, starts = np.unique(taxonomy_ids, return_index=True)
+            for taxonomy_id, group in zip(unique_ids.tolist(), np.split(sequence_indices, starts[1:])):
+                self.factory.write(f"sequences_{taxonomy_id}", group.tobytes())
+            self.factory.write("fasta_uuid", self.sequences_db.uuid.bytes)
+            self.factory.write("tree", self.tree.serialize())
+            self.factory.write("num_sequences", np.int32(len(sequence_indices)).tobytes())
+            self.factory.write("num_labels", np.int32(len(unique_ids)).tobytes())
+            self.taxonomy_ids, self.sequence_indices = [], []
+        self.factory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,196 @@
+from dataclasses import dataclass, field
+import numpy as np
+import tensorflow as tf
+from typing import Dict, List, Optional, Sequence
+
+
+def _transformer_blocks(base: tf.keras.Model) -> List[tf.keras.layers.Layer]:
+    """
+    The transformer blocks in a DNABERT base model's functional graph, in order.
+    """
+    return [layer for layer in base.model.layers if "TransformerBlock" in type(layer).__name__]
+
+
+class EarlyExitHeads:
+    """
+    Lightweight classification heads attached to intermediate transformer blocks of a DNABERT
+    taxonomy model. Each head pools its block's token embeddings and predicts every rank that the
+    full model predicts.
+
+    The network is split into segments ending at each exit block, so the hidden states computed
+    for one exit are reused by the next, and a tail from the last exit block through the remaining
+    blocks, the encoder's pooling and the model's own heads, so sequences that never exit resume
+    from the last exit's hidden states.
+    """
+    def __init__(self, model: tf.keras.Model, blocks: Sequence[int], output_units: Sequence[int]):
+        transformer_blocks = _transformer_blocks(model.base.base)
+        self.depth = len(transformer_blocks)
+        if len(blocks) == 0:
+            raise ValueError("At least one exit block is required.")
+        if not all(1 <= block < self.depth for block in blocks) or list(blocks) != sorted(set(blocks)):
+            raise ValueError(f"Exit blocks must be increasing and within 1-{self.depth - 1}, got {list(blocks)}.")
+        self.model = model
+        self.blocks = list(blocks)
+        self.output_units = list(output_units)
+        self.segments: List[tf.keras.Model] = []
+        self.heads: List[tf.keras.Model] = []
+        inputs = model.base.base.model.input
+        for block in self.blocks:
+            outputs = transformer_blocks[block - 1].output
+            self.segments.append(tf.keras.Model(inputs, outputs))
+            x = tf.keras.Input(outputs.shape[1:])
+            pooled = tf.keras.layers.GlobalAveragePooling1D()(x)
+            self.heads.append(tf.keras.Model(x, [
+                tf.keras.layers.Dense(units, activation="softmax")(pooled) for units in self.output_units]))
+            inputs = outputs
+        # The tail follows the functional graphs the model is nested from: the DNABERT base's
+        # remaining blocks, the encoder's pooling of the base output, and the taxonomy heads
+        # applied to the encoder output
+        encoder = model.base
+        self.tail = [
+            tf.keras.Model(inputs, encoder.base.model.output),
+            tf.keras.Model(encoder.base.output, encoder.model.output),
+            tf.keras.Model(encoder.output, model.model.outputs)]
+
+    def resume(self, hidden) -> List[tf.Tensor]:
+        """
+        The full model's outputs given the hidden states after the last exit block.
+        """
+        for part in self.tail:
+            hidden = part(hidden, training=False)
+        return tf.nest.flatten(hidden)
+
+    @classmethod
+    def create(cls, model: tf.keras.Model, blocks: Sequence[int], x: np.ndarray) -> "EarlyExitHeads":
+        """
+        Attach untrained heads matching the outputs the model produces for the given input.
+        """
+        output_units = [int(y.shape[-1]) for y in tf.nest.flatten(model(x, training=False))]
+        return cls(model, blocks, output_units)
+
+    @classmethod
+    def from_config(cls, model: tf.keras.Model, config: Dict, weights: List[np.ndarray]) -> "EarlyExitHeads":
+        heads = cls(model, config["blocks"], config["output_units"])
+        heads.set_weights(weights)
+        return heads
+
+    def get_config(self) -> Dict:
+        return {"blocks": self.blocks, "output_units": self.output_units}
+
+    @property
+    def trainable_variables(self) -> List[tf.Variable]:
+        return [v for head in self.heads for v in head.trainable_variables]
+
+    def get_weights(self) -> List[np.ndarray]:
+        return [w for head in self.heads for w in head.get_weights()]
+
+    def set_weights(self, weights: List[np.ndarray]):
+        offset = 0
+        for head in self.heads:
+            n = len(head.weights)
+            head.set_weights([np.array(w) for w in weights[offset:offset+n]])
+            offset += n
+
+    def __call__(self, x, training=None) -> List[List[tf.Tensor]]:
+        """
+        The outputs of every exit head for the given inputs.
+        """
+        outputs = []
+        for segment, head in zip(self.segments, self.heads):
+            x = segment(x, training=False)
+            outputs.append(head(x, training=training))
+        return outputs
+
+
+class _ExitHeadTrainer(tf.keras.Model):
+    """
+    Trains the exit heads to reproduce the full model's outputs (self-distillation), leaving the
+    model itself untouched.
+    """
+    def __init__(self, heads: EarlyExitHeads):
+        super().__init__()
+        self.exit_heads = heads
+        self.kl_divergence = tf.keras.losses.KLDivergence()
+
+    def train_step(self, data):
+        x = data[0] if isinstance(data, tuple) else data
+        targets = tf.nest.flatten(self.exit_heads.model(x, training=False))
+        with tf.GradientTape() as tape:
+            loss = tf.add_n([
+                self.kl_divergence(t, y)
+                for outputs in self.exit_heads(x, training=True)
+                for t, y in zip(targets, tf.nest.flatten(outputs))])
+        variables = self.exit_heads.trainable_variables
+        self.optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+        return {"loss": loss}
+
+
+def train_exit_heads(heads: EarlyExitHeads, train_data, epochs: int, callbacks=None, verbose: int = 0):
+    trainer = _ExitHeadTrainer(heads)
+    trainer.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-3))
+    return trainer.fit(train_data, epochs=epochs, callbacks=callbacks, verbose=verbose)
+
+
+@dataclass
+class ExitStatistics:
+    sequences: int = 0
+    # The block each sequence's prediction was taken from
+    exit_blocks: int = 0
+    # The number of times an exit head was evaluated on a sequence
+    head_evaluations: int = 0
+    exits: Dict[int, int] = field(default_factory=dict)
+
+    def to_dict(self, depth: int) -> Dict:
+        return {
+            "sequences": self.sequences,
+            "depth": depth,
+            "average_exit_depth": round(self.exit_blocks / self.sequences, 4) if self.sequences else None,
+            "average_head_evaluations": round(self.head_evaluations / self.sequences, 4) if self.sequences else None,
+            "exits": {str(block): count for block, count in sorted(self.exits.items())}
+        }
+
+
+def use_early_exit(
+    heads: EarlyExitHeads,
+    threshold: float,
+    rank: int,
+    statistics: Optional[ExitStatistics] = None
+) -> ExitStatistics:
+    """
+    Route the model's predict() batches through the exit heads. A sequence stops at the first
+    exit whose confidence at the given rank meets the threshold, and the remaining sequences
+    continue through the rest of the model. Any post-processing the model applies in predict() is unaffected.
+    """
+    statistics = statistics if statistics is not None else ExitStatistics()
+    def predict_function(iterator):
+        x, _, _ = tf.keras.utils.unpack_x_y_sample_weight(next(iterator))
+        x = np.asarray(x)
+        results: Optional[List[np.ndarray]] = None
+        remaining = np.arange(len(x))
+        hidden = x
+        for block, segment, head in zip(heads.blocks, heads.segments, heads.heads):
+            hidden = segment(hidden, training=False)
+            probabilities = [p.numpy() for p in tf.nest.flatten(head(hidden, training=False))]
+            statistics.head_evaluations += len(remaining)
+            if results is None:
+                results = [np.zeros((len(x),) + p.shape[1:], dtype=p.dtype) for p in probabilities]
+            confident = probabilities[rank].max(axis=-1) >= threshold
+            for result, p in zip(results, probabilities):
+                result[remaining[confident]] = p[confident]
+            statistics.exits[block] = statistics.exits.get(block, 0) + int(confident.sum())
+            statistics.exit_blocks += block*int(confident.sum())
+            remaining = remaining[~confident]
+            hidden = tf.gather(hidden, np.flatnonzero(~confident))
+            if len(remaining) == 0:
+                break
+        if len(remaining) > 0:
+            # Continue from the last exit's hidden states rather than recomputing the first blocks
+            full = [y.numpy() for y in heads.resume(hidden)]
+            for result, y in zip(results, full): # type: ignore
+                result[remaining] = y
+            statistics.exits[heads.depth] = statistics.exits.get(heads.depth, 0) + len(remaining)
+            statistics.exit_blocks += heads.depth*len(remaining)
+        statistics.sequences += len(x)
+        return results[0] if len(results) == 1 else results # type: ignore
+    heads.model.predict_function = predict_function
+    return statistics
@@ -0,0 +1,115 @@
+from dnadb import dna, fasta
+import json
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Union
+
+PACKINGS = ("uint8", "2bit")
+
+
+def _pack(encoded: np.ndarray) -> np.ndarray:
+    """
+    Pack rows of bases (0-3) four to a byte, the first base in the lowest bits.
+    """
+    width = -(-encoded.shape[1] // 4) * 4
+    padded = np.zeros((encoded.shape[0], width), dtype=np.uint8)
+    padded[:, :encoded.shape[1]] = encoded
+    padded = padded.reshape(encoded.shape[0], -1, 4)
+    return (padded[..., 0] | padded[..., 1] << 2 | padded[..., 2] << 4 | padded[..., 3] << 6).astype(np.uint8)
+
+
+class EncodedSequences:
+    """
+    The sequences of a sequence DB encoded once into fixed-width base arrays, stored as
+    memory-mapped .npy shards alongside their lengths.
+
+    With uint8 packing, each base keeps its full IUPAC code (see dnadb.dna) so that ambiguous bases
+    can still be resolved at random for every sample. With 2-bit packing, ambiguous bases are
+    resolved once while encoding.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / "index.json") as f:
+            index = json.load(f)
+        self.sequences_uuid: str = index["sequences_uuid"]
+        self.packing: str = index["packing"]
+        self.shards = [np.load(self.path / f"sequences-{i}.npy", mmap_mode="r") for i in range(len(index["shards"]))]
+        self.lengths = [np.load(self.path / f"lengths-{i}.npy", mmap_mode="r") for i in range(len(index["shards"]))]
+        self.offsets = np.cumsum([0] + [len(lengths) for lengths in self.lengths])
+        self._eligible: Dict[int, np.ndarray] = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @classmethod
+    def write(
+        cls,
+        path: Union[str, Path],
+        sequences_db: fasta.FastaDb,
+        packing: str = "uint8",
+        max_length: Optional[int] = None,
+        shard_size: int = 100_000
+    ) -> Iterator[int]:
+        """
+        Encode the sequences of the DB into shards at the given path, yielding the number of
+        sequences written as each shard is finished. Each shard is as wide as its longest sequence.
+        """
+        if packing not in PACKINGS:
+            raise ValueError(f"Unknown packing {packing!r}, expected one of {PACKINGS}.")
+        path = Path(path)
+        rng = np.random.default_rng(0)
+        shards = []
+        for start in range(0, len(sequences_db), shard_size):
+            sequences = [
+                sequences_db.entry(i).sequence[:max_length]
+                for i in range(start, min(start + shard_size, len(sequences_db)))]
+            lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int32)
+            encoded = np.zeros((len(sequences), lengths.max(initial=0)), dtype=np.uint8)
+            for row, sequence in zip(encoded, sequences):
+                row[:len(sequence)] = dna.encode_sequence(sequence)
+            if packing == "2bit":
+                encoded = _pack(dna.replace_ambiguous_encoded_bases(encoded, rng))
+            np.save(path / f"sequences-{len(shards)}.npy", encoded)
+            np.save(path / f"lengths-{len(shards)}.npy", lengths)
+            shards.append({"size": len(sequences), "width": int(lengths.max(initial=0))})
+            yield len(sequences)
+        with open(path / "index.json", "w") as f:
+            json.dump({
+                "sequences_uuid": str(sequences_db.uuid),
+                "packing": packing,
+                "max_length": max_length,
+                "shards": shards
+            }, f)
+
+    def eligible(self, sequence_length: int) -> np.ndarray:
+        """
+        The global indices of the sequences at least as long as the given length.
+        """
+        if sequence_length not in self._eligible:
+            self._eligible[sequence_length] = np.concatenate([
+                np.flatnonzero(np.asarray(lengths) >= sequence_length) + offset
+                for lengths, offset in zip(self.lengths, self.offsets)])
+            if len(self._eligible[sequence_length]) == 0:
+                raise ValueError(f"No encoded sequences are at least {sequence_length} bases long.")
+        return self._eligible[sequence_length]
+
+    def sample(self, batch_size: int, sequence_length: int, rng: np.random.Generator) -> np.ndarray:
+        """
+        Crop a random window of the given length from each of a batch of random sequences.
+        Sequences shorter than the window are never drawn.
+        """
+        indices = rng.choice(self.eligible(sequence_length), batch_size)
+        shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        batch = np.empty((batch_size, sequence_length), dtype=np.uint8)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            rows = indices[mask] - self.offsets[shard_id]
+            starts = rng.integers(0, self.lengths[shard_id][rows] - sequence_length + 1)
+            positions = starts[:, None] + np.arange(sequence_length)
+            if self.packing == "2bit":
+                packed = self.shards[shard_id][rows[:, None], positions // 4]
+                batch[mask] = (packed >> (2*(positions % 4)).astype(np.uint8)) & 3
+            else:
+                batch[mask] = self.shards[shard_id][rows[:, None], positions]
+        return batch
+
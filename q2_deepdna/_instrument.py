@@ -0,0 +1,118 @@
+from dataclasses import dataclass, field
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Where to emit the metrics: "stderr" (default), a file path to append to, or "off".
+METRICS_ENV = "Q2_DEEPDNA_METRICS"
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+@dataclass
+class Stage:
+    name: str
+    unit: str = "items"
+    calls: int = 0
+    items: int = 0
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    # The process high-water mark at the end of the stage
+    peak_rss_mb: Optional[float] = None
+
+    def __enter__(self) -> "Stage":
+        self.calls += 1
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wall_time += time.perf_counter() - self._wall_start
+        self.cpu_time += time.process_time() - self._cpu_start
+        self.peak_rss_mb = peak_rss_mb()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "items": self.items,
+            "unit": self.unit,
+            "wall_time_s": round(self.wall_time, 6),
+            "cpu_time_s": round(self.cpu_time, 6),
+            "peak_rss_mb": self.peak_rss_mb,
+            f"{self.unit}_per_second": round(self.items / self.wall_time, 3) if self.wall_time > 0 else None,
+        }
+
+
+@dataclass
+class Instrumentation:
+    """
+    Lightweight per-stage timing for an action.
+
+    Stages are accumulated across repeated calls and emitted as JSON lines when the action
+    finishes. The destination is controlled by the Q2_DEEPDNA_METRICS environment variable.
+    """
+    action: str
+    destination: str = field(default_factory=lambda: os.environ.get(METRICS_ENV, "stderr"))
+    stages: Dict[str, Stage] = field(default_factory=dict)
+    events: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def enabled(self) -> bool:
+        return self.destination.lower() not in ("", "0", "off", "none", "disabled")
+
+    def stage(self, name: str, unit: str = "items") -> Stage:
+        """
+        Get the stage with the given name. Use it as a context manager to time a block and
+        increment its `items` to record throughput.
+        """
+        if name not in self.stages:
+            self.stages[name] = Stage(name, unit)
+        return self.stages[name]
+
+    def event(self, name: str, **fields):
+        """
+        Record a one-off event to emit alongside the stage metrics.
+        """
+        self.events.append({"event": name, **fields})
+
+    def __enter__(self) -> "Instrumentation":
+        self._total = Stage("total").__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._total.__exit__(exc_type, exc_val, exc_tb)
+        if not self.enabled:
+            return
+        status = "failed" if exc_type is not None else "completed"
+        records = [
+            *({"action": self.action, **event} for event in self.events),
+            *({"action": self.action, **stage.to_dict()} for stage in self.stages.values()),
+            {
+                "action": self.action,
+                "stage": "total",
+                "wall_time_s": round(self._total.wall_time, 6),
+                "cpu_time_s": round(self._total.cpu_time, 6),
+                "peak_rss_mb": self._total.peak_rss_mb,
+                "status": status
+            }
+        ]
+        lines = "".join(json.dumps(record) + '\n' for record in records)
+        if self.destination.lower() == "stderr":
+            sys.stderr.write(lines)
+            sys.stderr.flush()
+        else:
+            with open(self.destination, 'a') as f:
+                f.write(lines)
@@ -0,0 +1,148 @@
+import fcntl
+from dnadb import fasta, taxonomy
+from lmdbm import Lmdb
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+import weakref
+
+# How an on-disk LMDB environment is transferred into a new artifact:
+#   auto (default) - reflink data.mdb, else hard link it, else copy the environment
+#   link           - as auto, but never fall back to copying
+#   copy           - copy the environment with LMDB
+#   compact        - copy the environment with LMDB, omitting free pages
+#   rewrite        - rewrite every entry through a dnadb factory
+COPY_MODE_ENV = "Q2_DEEPDNA_LMDB_COPY"
+
+COPY_MODES = ("auto", "link", "copy", "compact", "rewrite")
+
+# Whether the OS may read ahead when paging in a read-only DB (1/0). Disabling it helps random
+# sampling from DBs larger than memory.
+READAHEAD_ENV = "Q2_DEEPDNA_LMDB_READAHEAD"
+
+# The ioctl request to clone a file's extents (Linux, e.g. on Btrfs and XFS)
+FICLONE = 0x40049409
+
+
+def copy_mode() -> str:
+    mode = os.environ.get(COPY_MODE_ENV, "auto")
+    if mode not in COPY_MODES:
+        raise ValueError(f"Invalid {COPY_MODE_ENV} {mode!r}, expected one of {COPY_MODES}.")
+    return mode
+
+
+def _reflink(source: Path, destination: Path) -> bool:
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        destination.unlink(missing_ok=True)
+        return False
+
+
+def _hard_link(source: Path, destination: Path) -> bool:
+    try:
+        os.link(source, destination)
+        return True
+    except OSError:
+        return False
+
+
+def copy_environment(db, destination: Union[str, Path], mode: Optional[str] = None) -> Optional[str]:
+    """
+    Transfer the LMDB environment backing a dnadb database into the destination directory without
+    touching individual entries. Returns the method used, or None if the database must be rewritten.
+
+    Linking shares data.mdb with the source, which is safe because dnadb opens existing databases
+    read-only and factories always create new files.
+    """
+    mode = mode or copy_mode()
+    if mode == "rewrite":
+        return None
+    destination = Path(destination)
+    source = Path(db.path) / "data.mdb"
+    if not source.is_file():
+        return None
+    method = None
+    if mode in ("auto", "link"):
+        if _reflink(source, destination / "data.mdb"):
+            method = "reflink"
+        elif _hard_link(source, destination / "data.mdb"):
+            method = "hard_link"
+        elif mode == "link":
+            raise OSError(f"Unable to link {source} into {destination}.")
+    if method is None:
+        # A consistent snapshot written by LMDB itself, even while other readers are active
+        db.db.env.copy(str(destination), compact=(mode == "compact"))
+        method = "compact" if mode == "compact" else "copy"
+    # LMDB initializes the lock file on open; the format only requires it to exist
+    (destination / "lock.mdb").touch()
+    return method
+
+
+# Read-only Access ---------------------------------------------------------------------------------
+
+# Read-only handles to reopen in forked children
+_handles = weakref.WeakSet()
+
+
+def read_only_options() -> Dict[str, Any]:
+    return {
+        "lock": False,
+        "readahead": os.environ.get(READAHEAD_ENV, "1") not in ("0", "false", "False")
+    }
+
+
+def _open_read_only(path: Union[str, Path]) -> Lmdb:
+    return Lmdb.open(str(path), "r", **read_only_options())
+
+
+class _ReadOnlyDb:
+    """
+    Serves a dnadb database's reads from an environment of its own, opened with the options above
+    and reopened in forked children, since LMDB environments must not be used across a fork. dnadb
+    reads everything through the `db` property, so once its constructor has read the header, the
+    environment it opened is closed and replaced.
+    """
+    def __init__(self, path: Union[str, Path], *args, **kwargs):
+        self._environment: Optional[Lmdb] = None
+        super().__init__(path, *args, **kwargs)
+        super().close()
+        self._environment = _open_read_only(self.path)
+        _handles.add(self)
+
+    @property
+    def db(self) -> Lmdb:
+        return self._environment if self._environment is not None else super().db
+
+    def reopen(self):
+        # Without a lock table, closing the inherited handle only unmaps the child's copy
+        self._environment.close()
+        self._environment = _open_read_only(self.path)
+
+    @property
+    def is_open(self) -> bool:
+        return self._environment is not None
+
+    def close(self):
+        if self._environment is not None:
+            self._environment.close()
+            self._environment = None
+
+
+class ReadOnlyFastaDb(_ReadOnlyDb, fasta.FastaDb):
+    pass
+
+
+class ReadOnlyTaxonomyDb(_ReadOnlyDb, taxonomy.TaxonomyDb):
+    pass
+
+
+def _reopen_after_fork():
+    for db in list(_handles):
+        if db.is_open:
+            db.reopen()
+
+
+os.register_at_fork(after_in_child=_reopen_after_fork)
@@ -0,0 +1,46 @@
+import os
+from typing import Optional
+
+from ._instrument import peak_rss_mb
+
+MiB = 2**20
+
+def current_rss() -> int:
+    """
+    The resident set size of the process in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return int((peak_rss_mb() or 0) * MiB)
+
+
+class MemoryBudget:
+    """
+    A memory budget for an action, given in MiB.
+    """
+    def __init__(self, max_memory: int, action: str):
+        self.limit = max_memory * MiB
+        self.action = action
+
+    @classmethod
+    def create(cls, max_memory: Optional[int], action: str) -> Optional["MemoryBudget"]:
+        return cls(max_memory, action) if max_memory is not None else None
+
+    def remaining(self) -> int:
+        return self.limit - current_rss()
+
+    def require(self, estimate: int, description: str):
+        """
+        Fail fast if the estimated additional memory does not fit in the remaining budget.
+        """
+        remaining = self.remaining()
+        if estimate > remaining:
+            raise MemoryError(
+                f"{self.action} requires an estimated {estimate / MiB:,.0f} MiB for {description}, "
+                f"but only {max(remaining, 0) / MiB:,.0f} MiB of the {self.limit / MiB:,.0f} MiB "
+                f"max_memory budget remains ({current_rss() / MiB:,.0f} MiB in use).")
+
+    def exceeded(self, fraction: float = 0.9) -> bool:
+        return current_rss() > fraction*self.limit
@@ -0,0 +1,64 @@
+import contextlib
+import tensorflow as tf
+from typing import Any
+
+# Keras mixed-precision policies. bfloat16 has float32's exponent range, so unlike float16 it
+# trains without loss scaling.
+PRECISIONS = ("float32", "mixed_bfloat16")
+
+
+@contextlib.contextmanager
+def precision_scope(precision: str):
+    """
+    Build any layers created within the scope with the given Keras mixed-precision policy.
+    Variables are kept in float32 while computations run in the policy's compute dtype.
+    """
+    assert precision in PRECISIONS, f"Unknown precision: {precision}"
+    previous = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(precision)
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous)
+
+
+def model_precision(config: dict) -> str:
+    """
+    The precision recorded in a model manifest's config. The outer Keras model's own policy is
+    not reliable, since a float32 taxonomy model may wrap a mixed_bfloat16 encoder.
+    """
+    return config.get("model", {}).get("precision", "float32")
+
+
+def _is_float_policy(dtype: Any) -> bool:
+    # Mixed policies serialize as {"class_name": "Policy", "config": {"name": ...}}
+    if isinstance(dtype, dict) and dtype.get("class_name") == "Policy":
+        dtype = dtype.get("config", {}).get("name")
+    return isinstance(dtype, str) and dtype in PRECISIONS
+
+
+def _with_policy(config: Any, precision: str) -> Any:
+    """
+    Replace the floating point policies of every layer in a serialized Keras config. Integer
+    dtypes, such as those of the token inputs, are left as is.
+    """
+    if isinstance(config, dict):
+        return {
+            key: precision if key == "dtype" and _is_float_policy(value) else _with_policy(value, precision)
+            for key, value in config.items()}
+    if isinstance(config, list):
+        return [_with_policy(value, precision) for value in config]
+    return config
+
+
+def cast_model(model: tf.keras.Model, precision: str) -> tf.keras.Model:
+    """
+    Rebuild the model with every layer on the given precision policy and copy its weights over.
+    """
+    # Variable dimensions, such as the set axis of SetBERT models, are built with a single element
+    shape = tuple(1 if dim is None else dim for dim in model.input_shape[1:])
+    with precision_scope(precision):
+        cast = model.__class__.from_config(_with_policy(model.get_config(), precision))
+        cast(tf.zeros((1,) + shape, dtype=tf.int32), training=False)
+    cast.set_weights(model.get_weights())
+    return cast
@@ -0,0 +1,98 @@
+import os
+import tensorflow as tf
+import time
+from typing import Dict, List, Optional
+
+# The directory to write TensorFlow profiler traces to. Profiling is disabled when unset.
+PROFILE_DIR_ENV = "Q2_DEEPDNA_PROFILE_DIR"
+
+# The window of inference batches/training steps to trace as "start:stop" (stop exclusive).
+PROFILE_WINDOW_ENV = "Q2_DEEPDNA_PROFILE_WINDOW"
+
+
+class Profiler:
+    """
+    Captures a tf.profiler trace over a window of steps.
+    """
+    def __init__(self, logdir: str, start: int = 10, stop: int = 20):
+        assert 0 <= start < stop, "Invalid profiling window"
+        self.logdir = logdir
+        self.start = start
+        self.stop = stop
+        self.steps = 0
+        self.active = False
+
+    @classmethod
+    def from_environment(cls) -> Optional["Profiler"]:
+        logdir = os.environ.get(PROFILE_DIR_ENV)
+        if not logdir:
+            return None
+        start, stop = map(int, os.environ.get(PROFILE_WINDOW_ENV, "10:20").split(':'))
+        return cls(logdir, start, stop)
+
+    def step(self):
+        """
+        Mark the beginning of a step, starting or stopping the trace at the window boundaries.
+        """
+        if self.steps == self.start:
+            tf.profiler.experimental.start(self.logdir)
+            self.active = True
+        elif self.steps == self.stop:
+            self.close()
+        self.steps += 1
+
+    def close(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
+
+
+class ProfilerCallback(tf.keras.callbacks.Callback):
+    def __init__(self, profiler: Profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.profiler.step()
+
+    def on_train_end(self, logs=None):
+        self.profiler.close()
+
+
+class InputStallCallback(tf.keras.callbacks.Callback):
+    """
+    Measures how long each epoch waits between training steps, which is dominated by waiting on
+    the input pipeline. The stall time is added to the epoch logs as "input_stall_time".
+    """
+    def __init__(self):
+        super().__init__()
+        self.stalls: List[float] = []
+        self._stall = 0.0
+        self._last = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._stall = 0.0
+        self._last = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._stall += time.perf_counter() - self._last
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._last = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.stalls.append(self._stall)
+        if logs is not None:
+            logs["input_stall_time"] = self._stall
+
+
+def tracing_counts(model: tf.keras.Model) -> Dict[str, int]:
+    """
+    Count how many times each of the model's compiled Keras functions has been traced.
+    """
+    counts = {}
+    for name in ("train_function", "test_function", "predict_function"):
+        function = getattr(model, name, None)
+        if function is not None and hasattr(function, "experimental_get_tracing_count"):
+            counts[name] = function.experimental_get_tracing_count()
+    return counts
@@ -0,0 +1,137 @@
+from dataclasses import dataclass
+from dnadb import taxonomy
+import numpy as np
+import os
+import tensorflow as tf
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# float32 only converts the model, keeping its weights as they are
+QUANTIZATION_MODES = ("int8", "float16", "float32")
+
+# A flatbuffer held in memory, or the path of one in an artifact
+Flatbuffer = Union[bytes, Path]
+
+
+def quantize(model: tf.keras.Model, input_spec: tf.TensorSpec, mode: str) -> bytes:
+    """
+    Convert the model into a TFLite flatbuffer with int8 dynamic-range, float16 or float32 weights.
+    """
+    assert mode in QUANTIZATION_MODES, f"Unknown quantization mode: {mode}"
+    function = tf.function(lambda x: model(x, training=False))
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [function.get_concrete_function(input_spec)], model)
+    if mode != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    # Fall back to TensorFlow kernels for any ops without a TFLite builtin
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    return converter.convert()
+
+
+def read_flatbuffer(tflite_model: Flatbuffer) -> bytes:
+    if isinstance(tflite_model, bytes):
+        return tflite_model
+    return Path(tflite_model).read_bytes()
+
+
+class QuantizedRunner:
+    """
+    Runs a TFLite flatbuffer on the CPU through its serving signature, returning the outputs in
+    the order the Keras model produces them.
+
+    A flatbuffer given as a path is memory-mapped read-only, and its kernels read the constant
+    weights straight from the mapping, so every process classifying with the same artifact shares
+    one page-cache copy of them. The default XNNPACK delegate is skipped for the same reason: it
+    repacks the weights into buffers of its own in every process. float16 weights are still
+    dequantized per process when the interpreter is built; int8 and float32 weights are not.
+    """
+    def __init__(self, tflite_model: Flatbuffer, num_threads: Optional[int] = None):
+        if isinstance(tflite_model, bytes):
+            source = dict(model_content=tflite_model)
+        else:
+            source = dict(
+                model_path=str(tflite_model),
+                experimental_op_resolver_type=tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES)
+        self.interpreter = tf.lite.Interpreter(
+            **source,
+            num_threads=num_threads or os.cpu_count())
+        signatures = self.interpreter.get_signature_list()
+        if len(signatures) == 0:
+            raise ValueError("The quantized model has no serving signature. Quantize the model again.")
+        key, signature = next(iter(signatures.items()))
+        self.runner = self.interpreter.get_signature_runner(key)
+        self.input = signature["inputs"][0]
+        self.dtype = self.interpreter.get_input_details()[0]["dtype"]
+        # The tensor order of get_output_details() need not match the Keras outputs, but the
+        # signature names the flattened outputs output_0, output_1, ... in Keras order
+        self.outputs = list(signature["outputs"])
+        if all(name.startswith("output_") and name[7:].isdigit() for name in self.outputs):
+            self.outputs.sort(key=lambda name: int(name[7:]))
+
+    def __call__(self, x: np.ndarray) -> List[np.ndarray]:
+        results = self.runner(**{self.input: x.astype(self.dtype)})
+        return [results[name] for name in self.outputs]
+
+
+@dataclass(frozen=True)
+class TaxonomyPrediction:
+    # The predicted taxon at every rank, from the root down
+    taxonomies: Tuple[taxonomy.TaxonomyTree.Taxon, ...]
+    # The probability of each of those taxa at its rank
+    confidence: np.ndarray
+
+
+class QuantizedTaxonomyModel:
+    """
+    Runs a quantized top-down taxonomy model without its float Keras model. The per-rank
+    probabilities the flatbuffer outputs are decoded with the taxonomy tree stored in the
+    manifest: the most probable taxonomy at the deepest rank is predicted, along with the
+    probability of each of its ancestors at their rank.
+    """
+    def __init__(self, tflite_model: Flatbuffer, tree: taxonomy.TaxonomyTree):
+        self.runner = QuantizedRunner(tflite_model)
+        self.leaves = tree.taxonomy_id_map[-1]
+        # The taxonomy ID of every leaf's ancestor at each rank
+        self.ancestors = [
+            np.array([leaf.truncate(rank).taxonomy_id for leaf in self.leaves])
+            for rank in range(tree.depth)]
+
+    @classmethod
+    def from_config(cls, tflite_model: Flatbuffer, config: Dict) -> "QuantizedTaxonomyModel":
+        if "taxonomy_tree" not in config:
+            raise ValueError("The quantized model's manifest has no taxonomy tree. Quantize the model again.")
+        return cls(tflite_model, taxonomy.TaxonomyTree(**config["taxonomy_tree"]))
+
+    def predict(self, x: np.ndarray, batch_size: Optional[int] = None, verbose: Any = 0) -> np.ndarray:
+        """
+        Predict the taxonomy of every sequence, returning an object array of predictions shaped
+        like the inputs without their token axis.
+        """
+        batch_size = batch_size or len(x)
+        batches = [self.runner(x[i:i+batch_size]) for i in range(0, len(x), batch_size)]
+        probabilities = [np.concatenate(ranks) for ranks in zip(*batches)]
+        if len(probabilities) != len(self.ancestors):
+            raise ValueError(
+                f"The quantized model has {len(probabilities)} outputs, but its taxonomy tree has {len(self.ancestors)} ranks.")
+        leaves = probabilities[-1].argmax(axis=-1)
+        confidence = np.stack([
+            np.take_along_axis(p, ancestors[leaves][..., None], axis=-1)[..., 0]
+            for p, ancestors in zip(probabilities, self.ancestors)], axis=-1)
+        predictions = np.empty(leaves.shape, dtype=object)
+        for index in np.ndindex(leaves.shape):
+            leaf = self.leaves[leaves[index]]
+            predictions[index] = TaxonomyPrediction(
+                tuple(leaf.truncate(rank) for rank in range(len(self.ancestors))), confidence[index])
+        return predictions
+
+
+def taxonomy_predictor(model):
+    """
+    The model to classify with: the float Keras model, or the TFLite flatbuffer of a quantized
+    artifact, which is run without loading the float model.
+    """
+    if model.quantized is None:
+        return model.model
+    return QuantizedTaxonomyModel.from_config(model.quantized, model.manifest.config)
@@ -0,0 +1,51 @@
+import json
+import numpy as np
+from pathlib import Path
+from typing import List, Sequence, Union
+
+# Offsets are aligned so that mapped arrays satisfy TensorFlow's zero-copy alignment requirement.
+ALIGNMENT = 64
+
+def write_weights(path: Union[str, Path], weights: Sequence[np.ndarray]):
+    """
+    Write the given weights into a flat, memory-mappable layout.
+
+    The layout consists of a single contiguous `data.bin` file holding the raw weight buffers
+    and an `index.json` file describing the dtype, shape, and offset of each weight.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    index = []
+    offset = 0
+    with open(path / "data.bin", "wb") as f:
+        for weight in weights:
+            weight = np.ascontiguousarray(weight)
+            padding = -offset % ALIGNMENT
+            f.write(b"\0"*padding)
+            offset += padding
+            f.write(weight.tobytes())
+            index.append({
+                "dtype": weight.dtype.str,
+                "shape": list(weight.shape),
+                "offset": offset
+            })
+            offset += weight.nbytes
+    with open(path / "index.json", "w") as f:
+        json.dump({"alignment": ALIGNMENT, "weights": index}, f)
+
+
+def read_weights(path: Union[str, Path]) -> List[np.ndarray]:
+    """
+    Memory-map the weights stored in the given layout read-only. Every returned array is a view
+    into a single mapping; copy them before assigning them to Keras variables that outlive it.
+    """
+    path = Path(path)
+    with open(path / "index.json") as f:
+        index = json.load(f)["weights"]
+    if (path / "data.bin").stat().st_size == 0:
+        return [np.empty(entry["shape"], dtype=np.dtype(entry["dtype"])) for entry in index]
+    data = np.memmap(path / "data.bin", dtype=np.uint8, mode="r")
+    return [
+        np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=data, offset=entry["offset"])
+        for entry in index
+    ]
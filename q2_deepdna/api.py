@@ -0,0 +1,91 @@
+"""
+A library-level API for streaming taxonomy classification without QIIME 2 artifacts.
+"""
+import asyncio
+import numpy as np
+import pandas as pd
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, Literal, Mapping, Optional, Tuple, Union
+
+from . import models
+from .classify import TaxonomyStatistics, _accumulate, _assign, _encode, _subsample
+from ._quantize import taxonomy_predictor
+
+# (sample_id, {sequence_id: abundance})
+Sample = Tuple[str, Mapping[str, int]]
+
+# (sample_id, {sequence_id: (taxonomy label, confidence)})
+SampleTaxonomy = Tuple[str, Dict[str, Tuple[str, float]]]
+
+
+def _classify_sample(
+    model: models.SetBERTTaxonomyModel,
+    predictor,
+    sample: Sample,
+    sequences: Mapping[str, str],
+    confidence: Union[float, Literal["disable"]],
+    batch_size: int,
+    subsample_size: int,
+    rng: np.random.Generator
+) -> SampleTaxonomy:
+    sample_id, abundances = sample
+    abundances = pd.Series(abundances, dtype=int)
+    abundances = abundances[abundances > 0]
+    statistics: TaxonomyStatistics = {}
+    if len(abundances) > 0:
+        sequence_length, kmer, kmer_stride = model.tokenization()
+        sequence_ids = _subsample(abundances, subsample_size, rng)
+        x = _encode(sequence_ids, sequences, subsample_size, sequence_length, kmer, rng, kmer_stride)
+        _accumulate(statistics, sequence_ids, predictor.predict(x, batch_size=batch_size, verbose=0).flatten())
+    return sample_id, {
+        sequence_id: _assign(ranks, confidence)
+        for sequence_id, ranks in statistics.items()
+    }
+
+
+def classify_samples(
+    model: models.SetBERTTaxonomyModel,
+    samples: Iterable[Sample],
+    sequences: Mapping[str, str],
+    confidence: Union[float, Literal["disable"]] = 0.7,
+    batch_size: int = 1,
+    subsample_size: int = 1000,
+    rng: Optional[np.random.Generator] = None
+) -> Iterator[SampleTaxonomy]:
+    """
+    Classify the sequences of each sample, yielding the per-sequence taxonomy as each sample
+    finishes. Samples are only pulled from the given iterable as results are consumed.
+
+    `sequences` maps each sequence ID to its sequence, and may be any lazy lookup.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    predictor = taxonomy_predictor(model)
+    for sample in samples:
+        yield _classify_sample(model, predictor, sample, sequences, confidence, batch_size, subsample_size, rng)
+
+
+async def aclassify_samples(
+    model: models.SetBERTTaxonomyModel,
+    samples: Union[AsyncIterable[Sample], Iterable[Sample]],
+    sequences: Mapping[str, str],
+    confidence: Union[float, Literal["disable"]] = 0.7,
+    batch_size: int = 1,
+    subsample_size: int = 1000,
+    rng: Optional[np.random.Generator] = None
+) -> AsyncIterator[SampleTaxonomy]:
+    """
+    The asynchronous variant of `classify_samples`.
+
+    Inference runs in the default executor so the event loop stays responsive, and at most one
+    sample is in flight at a time so a slow consumer throttles how fast samples are pulled.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    predictor = taxonomy_predictor(model)
+    loop = asyncio.get_running_loop()
+    if isinstance(samples, AsyncIterable):
+        async for sample in samples:
+            yield await loop.run_in_executor(
+                None, _classify_sample, model, predictor, sample, sequences, confidence, batch_size, subsample_size, rng)
+    else:
+        for sample in samples:
+            yield await loop.run_in_executor(
+                None, _classify_sample, model, predictor, sample, sequences, confidence, batch_size, subsample_size, rng)
@@ -1,17 +1,34 @@
+import biom
 from dnadb import dna, fasta
+import h5py
+import hashlib
+import heapq
+import itertools
+import json
 import numpy as np
+import os
 import pandas as pd
+from pathlib import Path
 import skbio
-from qiime2.plugin import Bool, Choices, Int, Float, Range, Str
+import socket
+import tempfile
+import time
+from qiime2.plugin import Bool, Choices, Collection, Int, Float, Range, Str
 from q2_types.feature_data import DNAFASTAFormat, DNAIterator, FeatureData, Sequence, Taxonomy, TSVTaxonomyFormat
 from q2_types.feature_table import BIOMV210Format, Frequency, FeatureTable
 from q2_types.per_sample_sequences import SequencesWithQuality, PairedEndSequencesWithQuality, SingleLanePerSampleSingleEndFastqDirFmt, SingleLanePerSamplePairedEndFastqDirFmt
 from q2_types.sample_data import SampleData
 import tensorflow as tf
 from tqdm import tqdm
-from typing import Literal, Optional, Union
+from typing import Dict, Iterable, List, Literal, Optional, Set, Tuple, Union
 from . import models
-from ._registry import Field, register_method
+from ._compile import enable_jit_compile, pad_to_batches
+from ._instrument import Instrumentation, peak_rss_mb
+from ._memory import MemoryBudget
+from ._precision import PRECISIONS, cast_model, model_precision
+from ._profile import Profiler, tracing_counts
+from ._quantize import read_flatbuffer, taxonomy_predictor
+from ._registry import Field, register_method, register_pipeline
 from .types import (
     CSVFormat,
     CSVDirectoryFormat,
@@ -21,9 +38,17 @@ from .types import (
     DNABERTNaiveTaxonomyModel as DNABERTNaiveTaxonomyModelType,
     DNABERTTopDownTaxonomyModel as DNABERTTopDownTaxonomyModelType,
     SetBERTTaxonomyModel as SetBERTTaxonomyModelType,
-    SetBERTClassificationModel as SetBERTClassificationModelType
+    SetBERTClassificationModel as SetBERTClassificationModelType,
+    TaxonomyStatistics as TaxonomyStatisticsType,
+    TaxonomyStatisticsFormat
 )
 
+# sequence_id -> rank -> taxonomy label -> (confidence sum, count)
+TaxonomyStatistics = Dict[str, List[Dict[str, Tuple[float, int]]]]
+
+# The Unix socket of the local inference server (see q2_deepdna.server)
+DEFAULT_SERVER_SOCKET = os.environ.get("Q2_DEEPDNA_SERVER", "/tmp/q2-deepdna.sock")
+
 # from deepdna.nn.models.taxonomy import AbstractTaxonomyClassificationModel, NaiveTaxonomyPrediction, HierarchicalTaxonomyPrediction
 
 # def _sequence_iterator(sequences, batch_size):
@@ -115,6 +140,444 @@ def _trim(sequence, length, rng):
     start = rng.integers(0, len(sequence) - length + 1)
     return sequence[start:start+length]
 
+def _read_sequences(sequences: DNAFASTAFormat) -> Dict[str, str]:
+    sequence_map = {}
+    with sequences.open() as f:
+        for entry in fasta.entries(f):
+            sequence_map[entry.identifier] = entry.sequence
+    return sequence_map
+
+def _read_inputs(
+    metrics: Instrumentation,
+    sequences: DNAFASTAFormat,
+    frequency_table: BIOMV210Format
+) -> Tuple[Dict[str, str], pd.DataFrame]:
+    with metrics.stage("fasta_parsing", unit="sequences") as stage:
+        sequence_map = _read_sequences(sequences)
+        stage.items += len(sequence_map)
+    with metrics.stage("biom_densification", unit="samples") as stage:
+        frequency: pd.DataFrame = frequency_table.view(pd.DataFrame)
+        stage.items += len(frequency)
+    return sequence_map, frequency
+
+def _subsample(abundances, subsample_size, rng):
+    """
+    Draw the subsample sets for a single sample, returning the shuffled sequence ID of each
+    element in the sets.
+    """
+    n = abundances.sum()
+    relative_abundance = abundances / n
+    indices = rng.choice(abundances.index, size=subsample_size-(n%subsample_size), p=relative_abundance, replace=True)
+    indices, counts = np.unique(indices, return_counts=True)
+    abundances[indices] += counts
+    sequence_ids = np.array([sequence_id for sequence_id, count in abundances.items() for _ in range(count)])
+    return sequence_ids[rng.permutation(len(sequence_ids))]
+
+def _encode(sequence_ids, sequence_map, subsample_size, sequence_length, kmer, rng, kmer_stride=1):
+    """
+    Trim, augment, and encode the given sequences into (strided) k-mer subsample sets.
+    """
+    x = np.array([
+        dna.encode_sequence(dna.augment_ambiguous_bases(_trim(sequence_map[sequence_id], sequence_length, rng), rng))
+        for sequence_id in sequence_ids])
+    x = models.encode_kmers(x, kmer, kmer_stride)
+    return x.reshape((-1, subsample_size, x.shape[-1]))
+
+def _available_memory() -> int:
+    """
+    The number of bytes of physical memory currently available to the process.
+    """
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def _calibrate_batch_size(
+    model: models.SetBERTTaxonomyModel,
+    predictor,
+    x: np.ndarray,
+    candidates: Iterable[int] = (1, 2, 4, 8, 16, 32, 64),
+    memory_limit: Optional[int] = None
+) -> Tuple[int, Dict[int, float]]:
+    """
+    Measure the throughput of each candidate batch size on the given subsample sets and select
+    the fastest one that stays within the memory limit (80% of the available memory by default).
+    Candidates are checked against the estimated memory of a batch before they are run.
+    """
+    # Peak RSS never decreases, so it only serves as the baseline the batches are added to
+    baseline = (peak_rss_mb() or 0)*2**20
+    if memory_limit is None:
+        memory_limit = baseline + 0.8*_available_memory()
+    per_set = _set_memory(model, x.shape[1])
+    throughputs: Dict[int, float] = {}
+    for candidate in candidates:
+        if baseline + candidate*per_set > memory_limit:
+            break
+        # Tile the sets to fill a whole batch of the candidate size
+        batch = np.resize(x, (candidate,) + x.shape[1:])
+        predictor.predict(batch, batch_size=candidate, verbose=0) # warm up/trace
+        start = time.perf_counter()
+        predictor.predict(batch, batch_size=candidate, verbose=0)
+        elapsed = time.perf_counter() - start
+        throughputs[candidate] = candidate / elapsed
+    if len(throughputs) == 0:
+        return 1, throughputs
+    return max(throughputs, key=throughputs.__getitem__), throughputs
+
+def _embedding_width(model: models.SetBERTTaxonomyModel) -> int:
+    """
+    The width of the encoder's token embeddings, which sets the size of the per-token activations.
+    """
+    if "embed_dim" in model.manifest.config.get("model", {}):
+        return model.manifest.config["model"]["embed_dim"]
+    # Older manifests lack the configuration; Keras names embedding tables ".../embeddings:0"
+    weights = model.model.weights if model.model is not None else []
+    embeddings = [w for w in weights if "embedding" in w.name and len(w.shape) == 2]
+    if len(embeddings) == 0:
+        raise ValueError("Could not determine the model's embedding width to plan its memory use.")
+    return int(embeddings[0].shape[-1])
+
+def _set_memory(model: models.SetBERTTaxonomyModel, subsample_size: int) -> int:
+    """
+    A rough upper bound on the bytes needed to run a single subsample set through the model.
+    """
+    tokens = models.num_tokens(*model.tokenization())
+    width = _embedding_width(model)
+    # The encoded inputs, a few live float32 activations per token, and the set-level attention
+    return subsample_size*tokens*8 + 4*subsample_size*tokens*width*4 + 8*subsample_size**2*4
+
+def _plan_memory(
+    budget: MemoryBudget,
+    model: models.SetBERTTaxonomyModel,
+    sequences: DNAFASTAFormat,
+    frequency_table: BIOMV210Format,
+    subsample_size: int
+) -> int:
+    """
+    Check that the inputs and a single subsample set fit in the budget before anything is read,
+    returning the largest batch size (in sets) that fits alongside the inputs.
+    """
+    # The table's dimensions are stored as an attribute of the BIOM HDF5 file
+    with h5py.File(str(frequency_table), "r") as f:
+        num_features, num_samples = (int(n) for n in f.attrs["shape"])
+    # Parsed Python strings take a few times their size on disk; the table is densified to 64 bits
+    inputs = 3*os.path.getsize(sequences.path) + num_samples*num_features*8
+    per_set = _set_memory(model, subsample_size)
+    budget.require(inputs + per_set, "the parsed inputs and a single subsample set")
+    return max(1, (budget.remaining() - inputs) // per_set)
+
+def _accumulate(statistics: TaxonomyStatistics, sequence_ids, predictions):
+    """
+    Accumulate the confidence sums and counts of the given predictions per rank and label.
+    """
+    for sequence_id, prediction in zip(sequence_ids, predictions):
+        if sequence_id not in statistics:
+            statistics[sequence_id] = [{} for _ in range(len(prediction.taxonomies))]
+        for taxon, conf in zip(prediction.taxonomies, prediction.confidence):
+            label = taxon.taxonomy_label
+            total, count = statistics[sequence_id][taxon.rank].get(label, (0.0, 0))
+            statistics[sequence_id][taxon.rank][label] = (total + conf, count + 1)
+
+def _merge_statistics(statistics: TaxonomyStatistics, other: TaxonomyStatistics):
+    for sequence_id, ranks in other.items():
+        if sequence_id not in statistics:
+            statistics[sequence_id] = [{} for _ in range(len(ranks))]
+        for rank, labels in enumerate(ranks):
+            for label, (other_total, other_count) in labels.items():
+                total, count = statistics[sequence_id][rank].get(label, (0.0, 0))
+                statistics[sequence_id][rank][label] = (total + other_total, count + other_count)
+
+def _classify_samples(
+    model: models.SetBERTTaxonomyModel,
+    sequence_map: Dict[str, str],
+    frequency: pd.DataFrame,
+    batch_size: Union[int, Literal["auto"]],
+    subsample_size: int,
+    seed: Optional[int] = None,
+    progress_dir: Optional[str] = None,
+    checkpoint_interval: int = 100,
+    metrics: Optional[Instrumentation] = None,
+    budget: Optional[MemoryBudget] = None,
+    max_batch_size: Optional[int] = None,
+    jit_compile: bool = False,
+    precision: Optional[str] = None
+) -> Union[TaxonomyStatistics, "_SpilledStatistics"]:
+    metrics = metrics if metrics is not None else Instrumentation("classify", destination="off")
+    if model.quantized is not None:
+        # Quantized models run through the TFLite interpreter instead of a compiled graph
+        metrics.event("quantization", **model.manifest.config.get("quantization", {}))
+        jit_compile = False
+    else:
+        if precision is not None and precision != model_precision(model.manifest.config):
+            model.model = cast_model(model.model, precision)
+            model.manifest.config.setdefault("model", {})["precision"] = precision
+        metrics.event("precision", policy=precision or model_precision(model.manifest.config))
+        if jit_compile:
+            enable_jit_compile(model.model)
+    predictor = taxonomy_predictor(model)
+    progress = None
+    if progress_dir is not None:
+        progress = _ClassificationProgress(progress_dir, _fingerprint(frequency, subsample_size, model, sequence_map), seed)
+        seed = progress.seed
+    sequence_length, kmer, kmer_stride = model.tokenization()
+    statistics: TaxonomyStatistics = progress.statistics() if progress is not None else {}
+    completed = progress.completed if progress is not None else set()
+    shard: TaxonomyStatistics = {}
+    shard_sample_ids = []
+    spilled = None
+    profiler = Profiler.from_environment()
+    rng = np.random.default_rng(seed)
+    for i, (sample_id, row) in enumerate(frequency.iterrows()):
+        if sample_id in completed:
+            continue
+        if seed is not None:
+            # Derive each sample's generator from its position so that resumed runs are identical
+            rng = np.random.default_rng([seed, i])
+        # Only keep non-zero row values
+        abundances = row[row > 0].astype(int)
+        with metrics.stage("subsampling", unit="samples") as stage:
+            sequence_ids = _subsample(abundances, subsample_size, rng)
+            stage.items += 1
+        with metrics.stage("encoding", unit="reads") as stage:
+            x = _encode(sequence_ids, sequence_map, subsample_size, sequence_length, kmer, rng, kmer_stride)
+            stage.items += len(sequence_ids)
+        if batch_size == "auto":
+            with metrics.stage("batch_size_calibration", unit="candidates") as stage:
+                candidates = [c for c in (1, 2, 4, 8, 16, 32, 64) if max_batch_size is None or c <= max_batch_size]
+                batch_size, throughputs = _calibrate_batch_size(
+                    model, predictor, x, candidates, memory_limit=budget.limit if budget is not None else None)
+                stage.items += len(throughputs)
+            metrics.event("batch_size", selected=batch_size, sets_per_second=throughputs)
+        if profiler is not None:
+            profiler.step()
+        with metrics.stage("predict", unit="sets") as stage:
+            if jit_compile:
+                # Pad the final batch so every call reuses the same compiled graph
+                taxa = predictor.predict(pad_to_batches(x, batch_size), batch_size=batch_size)[:len(x)].flatten()
+            else:
+                taxa = predictor.predict(x, batch_size=batch_size).flatten()
+            stage.items += len(x)
+        with metrics.stage("aggregation", unit="reads") as stage:
+            _accumulate(shard, sequence_ids, taxa)
+            stage.items += len(sequence_ids)
+        shard_sample_ids.append(sample_id)
+        if progress is not None and len(shard_sample_ids) >= checkpoint_interval:
+            progress.commit(shard_sample_ids, shard)
+            _merge_statistics(statistics, shard)
+            shard, shard_sample_ids = {}, []
+        if budget is not None and budget.exceeded():
+            # Move the aggregation state out of memory before the job outgrows its budget
+            with metrics.stage("spilling", unit="features") as stage:
+                if progress is not None and len(shard_sample_ids) > 0:
+                    progress.commit(shard_sample_ids, shard)
+                    shard_sample_ids = []
+                _merge_statistics(statistics, shard)
+                spilled = spilled if spilled is not None else _SpilledStatistics()
+                spilled.spill(statistics)
+                stage.items += len(statistics)
+                statistics, shard = {}, {}
+    if profiler is not None:
+        profiler.close()
+    if progress is not None and len(shard_sample_ids) > 0:
+        progress.commit(shard_sample_ids, shard)
+    _merge_statistics(statistics, shard)
+    if model.model is not None:
+        metrics.event("tracing", **tracing_counts(model.model))
+    if spilled is not None:
+        spilled.spill(statistics)
+        return spilled
+    return statistics
+
+def _assign(
+    ranks: List[Dict[str, Tuple[float, int]]],
+    confidence: Union[float, Literal["disable"]]
+) -> Tuple[str, float]:
+    """
+    Assign the deepest taxon whose mean confidence meets the confidence threshold.
+    """
+    for rank in range(len(ranks) - 1, -1, -1):
+        # Fetch the highest mean confidence taxon for each rank
+        taxon, conf = max(
+            ((label, total / count) for label, (total, count) in ranks[rank].items()),
+            key=lambda x: x[1])
+        if confidence == 'disable':
+            return taxon, -1
+        elif conf >= confidence:
+            return taxon, conf
+    if confidence == 'disable':
+        return 'Unassigned', -1
+    return 'Unassigned', 1 - conf
+
+def _write_taxonomy(
+    ff: TSVTaxonomyFormat,
+    statistics: Union[TaxonomyStatistics, "_SpilledStatistics"],
+    feature_ids: Optional[Iterable[str]],
+    confidence: Union[float, Literal["disable"]]
+) -> int:
+    """
+    Write the assigned taxonomy of each feature in the given order, or in the order of the
+    statistics if no feature IDs are given. Returns the number of features written.
+    """
+    if feature_ids is None:
+        items = statistics.items()
+    else:
+        items = ((sequence_id, statistics[sequence_id]) for sequence_id in feature_ids if sequence_id in statistics)
+    written = 0
+    with ff.open() as f:
+        f.write('\t'.join(ff.HEADER + ['Confidence']) + '\n')
+        # Aggregate predictions
+        for sequence_id, ranks in items:
+            taxon, conf = _assign(ranks, confidence)
+            f.write('\t'.join(map(str, [sequence_id, taxon, conf])) + '\n')
+            written += 1
+    return written
+
+def _dump_statistics(f, statistics: TaxonomyStatistics):
+    f.write('\t'.join(TaxonomyStatisticsFormat.HEADER) + '\n')
+    for sequence_id, ranks in statistics.items():
+        for rank, labels in enumerate(ranks):
+            for label, (total, count) in labels.items():
+                f.write('\t'.join(map(str, [sequence_id, rank, label, total, count])) + '\n')
+
+def _parse_statistics_row(line: str) -> Tuple[str, int, str, float, int]:
+    sequence_id, rank, label, total, count = line.rstrip('\n').split('\t')
+    return sequence_id, int(rank), label, float(total), int(count)
+
+def _load_statistics(f) -> TaxonomyStatistics:
+    statistics: TaxonomyStatistics = {}
+    next(f)
+    for line in f:
+        sequence_id, rank, label, total, count = _parse_statistics_row(line)
+        if sequence_id not in statistics:
+            statistics[sequence_id] = []
+        while len(statistics[sequence_id]) <= rank:
+            statistics[sequence_id].append({})
+        statistics[sequence_id][rank][label] = (total, count)
+    return statistics
+
+def _write_statistics(ff: TaxonomyStatisticsFormat, statistics: TaxonomyStatistics):
+    with ff.open() as f:
+        _dump_statistics(f, statistics)
+
+def _read_statistics(ff: TaxonomyStatisticsFormat) -> TaxonomyStatistics:
+    with ff.open() as f:
+        return _load_statistics(f)
+
+class _ClassificationProgress:
+    """
+    Commits the aggregated statistics of completed samples to a progress directory in shards so
+    that an interrupted classification can be resumed.
+    """
+    def __init__(self, path: str, fingerprint: str, seed: Optional[int]):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.shards: Dict[str, List[str]] = {}
+        if (self.path / "progress.json").exists():
+            with open(self.path / "progress.json") as f:
+                progress = json.load(f)
+            if progress["fingerprint"] != fingerprint:
+                raise ValueError(
+                    f"The progress directory {self.path} belongs to a run with different inputs.")
+            if seed is not None and seed != progress["seed"]:
+                raise ValueError(
+                    f"The progress directory {self.path} belongs to a run with seed {progress['seed']}.")
+            self.shards = progress["shards"]
+            seed = progress["seed"]
+        elif seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2**32)
+        self.fingerprint = fingerprint
+        self.seed: int = seed
+
+    @property
+    def completed(self) -> Set[str]:
+        return {sample_id for sample_ids in self.shards.values() for sample_id in sample_ids}
+
+    def statistics(self) -> TaxonomyStatistics:
+        statistics: TaxonomyStatistics = {}
+        for shard in self.shards:
+            with open(self.path / shard) as f:
+                _merge_statistics(statistics, _load_statistics(f))
+        return statistics
+
+    def _replace(self, name: str, write):
+        # Write to a temporary file first so a killed run never leaves a partial file behind
+        tmp = self.path / (name + ".tmp")
+        with open(tmp, 'w') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / name)
+
+    def commit(self, sample_ids: List[str], statistics: TaxonomyStatistics):
+        shard = f"shard-{len(self.shards):06d}.tsv"
+        self._replace(shard, lambda f: _dump_statistics(f, statistics))
+        self.shards[shard] = list(sample_ids)
+        self._replace("progress.json", lambda f: json.dump({
+            "fingerprint": self.fingerprint,
+            "seed": self.seed,
+            "shards": self.shards
+        }, f))
+
+class _SpilledStatistics:
+    """
+    Aggregated statistics spilled to disk as runs sorted by feature ID. The runs are merged one
+    feature at a time when iterated, so the full statistics never need to be held in memory.
+    """
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="q2-deepdna-spill-")
+        self.runs: List[str] = []
+
+    def spill(self, statistics: TaxonomyStatistics):
+        path = os.path.join(self.directory.name, f"run-{len(self.runs):06d}.tsv")
+        with open(path, 'w') as f:
+            _dump_statistics(f, {sequence_id: statistics[sequence_id] for sequence_id in sorted(statistics)})
+        self.runs.append(path)
+
+    def items(self) -> Iterable[Tuple[str, List[Dict[str, Tuple[float, int]]]]]:
+        files = [open(run) for run in self.runs]
+        try:
+            for f in files:
+                next(f)
+            rows = heapq.merge(*(map(_parse_statistics_row, f) for f in files), key=lambda row: row[0])
+            for sequence_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+                ranks: List[Dict[str, Tuple[float, int]]] = []
+                for _, rank, label, total, count in group:
+                    while len(ranks) <= rank:
+                        ranks.append({})
+                    other_total, other_count = ranks[rank].get(label, (0.0, 0))
+                    ranks[rank][label] = (total + other_total, count + other_count)
+                yield sequence_id, ranks
+        finally:
+            for f in files:
+                f.close()
+
+def _model_digest(model: models.SetBERTTaxonomyModel) -> str:
+    digest = hashlib.sha256(json.dumps(model.manifest.to_dict(), sort_keys=True, default=str).encode())
+    for weight in model.model.weights if model.model is not None else []:
+        digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+    if model.quantized is not None:
+        digest.update(read_flatbuffer(model.quantized))
+    return digest.hexdigest()
+
+def _fingerprint(
+    frequency: pd.DataFrame,
+    subsample_size: int,
+    model: models.SetBERTTaxonomyModel,
+    sequence_map: Dict[str, str]
+) -> str:
+    """
+    Identify the inputs of a classification run so that progress is only resumed by the same run.
+    The seed is checked separately, since a run without one resumes with the stored seed.
+    """
+    sequences = hashlib.sha256()
+    for sequence_id in sorted(sequence_map):
+        sequences.update(f"{sequence_id}\t{sequence_map[sequence_id]}\n".encode())
+    return hashlib.sha256(json.dumps({
+        "samples": list(map(str, frequency.index)),
+        "features": list(map(str, frequency.columns)),
+        "totals": frequency.values.sum(axis=1).astype(int).tolist(),
+        "subsample_size": subsample_size,
+        "model": _model_digest(model),
+        "sequences": sequences.hexdigest()
+    }).encode()).hexdigest()
+
 @register_method(
     "Classify taxonomy",
     description="Classify sequences using single-sequence taxonomy models.",
@@ -127,8 +590,14 @@ def _trim(sequence, length, rng):
     },
     parameters={
         "confidence": Field(Float % Range(0.0, 1.0, inclusive_start=True, inclusive_end=True) | Str % Choices(['disable']), "The confidence threshold to use for classification."), # type: ignore
-        "batch_size": Field(Int % Range(1, None), "The batch size to use for classification."), # type: ignore
-        "subsample_size": Field(Int % Range(1, None), "The subsample size to use for classification.") # type: ignore
+        "batch_size": Field(Int % Range(1, None) | Str % Choices(['auto']), "The batch size to use for classification. 'auto' calibrates the highest-throughput batch size that fits in memory on the first sample."), # type: ignore
+        "subsample_size": Field(Int % Range(1, None), "The subsample size to use for classification."), # type: ignore
+        "seed": Field(Int % Range(0, None), "The random seed to use for subsampling."), # type: ignore
+        "progress_dir": Field(Str, "A directory to commit progress to. Re-running with the same inputs and directory resumes an interrupted run."), # type: ignore
+        "checkpoint_interval": Field(Int % Range(1, None), "The number of samples per committed progress shard."), # type: ignore
+        "max_memory": Field(Int % Range(1, None), "The memory budget in MiB. Batch sizes are capped to fit, aggregation state is spilled to disk as the budget fills, and the run fails up front if the inputs cannot fit."), # type: ignore
+        "jit_compile": Field(Bool, "Run inference through an XLA-compiled graph with a fixed batch shape. Final batches are padded to the full batch size. Ignored for quantized models."), # type: ignore
+        "precision": Field(Str % Choices(list(PRECISIONS)), "The Keras precision policy to run inference with. Defaults to the precision the model was trained with. Ignored for quantized models.") # type: ignore
     },
     outputs={"classification": Field(FeatureData[Taxonomy], "The predicted taxonomy.")} # type: ignore
 )
@@ -142,66 +611,222 @@ def classify_taxonomy(
     #     SampleData[PairedEndSequencesWithQuality]
     # ],
     confidence: Union[float, Literal["disable"]] = 0.7,
-    batch_size: int = 1,
-    subsample_size: int = 1000
+    batch_size: Union[int, Literal["auto"]] = 1,
+    subsample_size: int = 1000,
+    seed: Optional[int] = None,
+    progress_dir: Optional[str] = None,
+    checkpoint_interval: int = 100,
+    max_memory: Optional[int] = None,
+    jit_compile: bool = False,
+    precision: Optional[str] = None
 ) -> TSVTaxonomyFormat:
-    print("Processing...", model, model.model)
-    rng = np.random.default_rng()
-    sequence_map = {}
-    with sequences.open() as f:
-        for entry in fasta.entries(f):
-            sequence_map[entry.identifier] = entry.sequence
-    frequency: pd.DataFrame = frequency_table.view(pd.DataFrame)
-    taxonomy_predictions = {}
-    for _, row in frequency.iterrows():
-        # Only keep non-zero row values
-        abundances = row[row > 0].astype(int)
-        n = abundances.sum()
-        relative_abundance = abundances / n
-        indices = rng.choice(abundances.index, size=subsample_size-(n%subsample_size), p=relative_abundance, replace=True)
-        indices, counts = np.unique(indices, return_counts=True)
-        abundances[indices] += counts
-        x = np.array([
-            dna.encode_sequence(dna.augment_ambiguous_bases(_trim(sequence_map[sequence_id], model.model.base.base.sequence_length, rng), rng))
-            for sequence_id, count in abundances.items() for _ in range(count)])
-        sequence_indices = np.array([sequence_id for sequence_id, count in abundances.items() for _ in range(count)])
-        indices = rng.permutation(len(x))
-        x = x[indices]
-        sequence_indices = sequence_indices[indices]
-        x = dna.encode_kmers(x, model.model.base.base.kmer)
-        x = x.reshape((-1, subsample_size, x.shape[-1]))
-        taxa = model.model.predict(x, batch_size=batch_size).flatten()
-        for sequence_id, prediction in zip(sequence_indices, taxa):
-            if sequence_id not in taxonomy_predictions:
-                taxonomy_predictions[sequence_id] = [{} for _ in range(len(prediction.taxonomies))]
-            for taxon, conf in zip(prediction.taxonomies, prediction.confidence):
-                label = taxon.taxonomy_label
-                if label not in taxonomy_predictions[sequence_id][taxon.rank]:
-                    taxonomy_predictions[sequence_id][taxon.rank][label] = []
-                taxonomy_predictions[sequence_id][taxon.rank][taxon.taxonomy_label].append(conf)
-
-    ff = TSVTaxonomyFormat()
-    with ff.open() as f:
-        f.write('\t'.join(ff.HEADER + ['Confidence']) + '\n')
-        # Aggregate predictions
-        for sequence_id in frequency.columns:
-            if sequence_id not in taxonomy_predictions:
-                continue
-            for rank in range(len(taxonomy_predictions[sequence_id]) - 1, -1, -1):
-                # Aggregate confidences across each label
-                for taxon, confidences in taxonomy_predictions[sequence_id][rank].items():
-                    taxonomy_predictions[sequence_id][rank][taxon] = np.mean(confidences)
-                # Fetch the highest confidence taxon for each rank
-                taxonomy_predictions[rank] = max(taxonomy_predictions[sequence_id][rank].items(), key=lambda x: x[1])
-                if confidence == 'disable':
-                    f.write('\t'.join(map(str, [sequence_id, taxonomy_predictions[rank][0], -1])) + '\n')
-                    break
-                elif taxonomy_predictions[rank][1] >= confidence:
-                    f.write('\t'.join(map(str, [sequence_id, taxonomy_predictions[rank][0], taxonomy_predictions[rank][1]])) + '\n')
-                    break
-            else:
-                if confidence == 'disable':
-                    f.write('\t'.join(map(str, [sequence_id, 'Unassigned', -1])) + '\n')
-                else:
-                    f.write('\t'.join(map(str, [sequence_id, 'Unassigned', 1 - taxonomy_predictions[0][1]])) + '\n')
+    with Instrumentation("classify_taxonomy") as metrics:
+        budget = MemoryBudget.create(max_memory, "classify_taxonomy")
+        max_batch_size = None
+        if budget is not None:
+            max_batch_size = _plan_memory(budget, model, sequences, frequency_table, subsample_size)
+            if batch_size != "auto" and batch_size > max_batch_size:
+                batch_size = max_batch_size
+            metrics.event("memory_budget", max_memory_mb=max_memory, max_batch_size=max_batch_size, batch_size=batch_size)
+        sequence_map, frequency = _read_inputs(metrics, sequences, frequency_table)
+        statistics = _classify_samples(
+            model, sequence_map, frequency, batch_size, subsample_size,
+            seed=seed,
+            progress_dir=progress_dir,
+            checkpoint_interval=checkpoint_interval,
+            metrics=metrics,
+            budget=budget,
+            max_batch_size=max_batch_size,
+            jit_compile=jit_compile,
+            precision=precision)
+        ff = TSVTaxonomyFormat()
+        with metrics.stage("tsv_writing", unit="features") as stage:
+            # Spilled statistics are written in feature ID order as they are merged from disk
+            feature_ids = frequency.columns if isinstance(statistics, dict) else None
+            stage.items += _write_taxonomy(ff, statistics, feature_ids, confidence)
+    return ff
+
+# Parallel Classification --------------------------------------------------------------------------
+
+@register_method(
+    "Partition frequency table",
+    description="Split a frequency table into sample shards for parallel classification.",
+    inputs={"frequency_table": Field(FeatureTable[Frequency], "The frequency table to partition.")}, # type: ignore
+    parameters={"num_partitions": Field(Int % Range(1, None), "The number of partitions to create. Defaults to the number of CPUs, capped at the number of samples.")}, # type: ignore
+    outputs={"partitioned_tables": Field(Collection[FeatureTable[Frequency]], "The partitioned frequency tables.")} # type: ignore
+)
+def partition_frequency_table(frequency_table: biom.Table, num_partitions: Optional[int] = None) -> biom.Table:
+    sample_ids = frequency_table.ids(axis="sample")
+    # Each partition loads the model, so default to one partition per CPU rather than per sample
+    if num_partitions is None:
+        num_partitions = os.cpu_count() or 1
+    num_partitions = min(num_partitions, len(sample_ids))
+    partitions = {}
+    for i, ids in enumerate(np.array_split(sample_ids, num_partitions)):
+        ids = set(ids)
+        table = frequency_table.filter(lambda _, sample_id, __: sample_id in ids, axis="sample", inplace=False)
+        partitions[str(i)] = table.remove_empty(axis="observation", inplace=False)
+    return partitions # type: ignore
+
+@register_method(
+    "Classify taxonomy statistics",
+    description="Compute the mergeable per-feature taxonomy statistics for a shard of samples.",
+    inputs={
+        "model": Field(DeepDNAModel[SetBERTTaxonomyModelType], "The model to use for classification."), # type: ignore
+        "sequences": Field(FeatureData[Sequence], "The sequences to classify."),
+        "frequency_table": Field(FeatureTable[Frequency], "The frequency table of the DNA sequences.")
+    },
+    parameters={
+        "batch_size": Field(Int % Range(1, None) | Str % Choices(['auto']), "The batch size to use for classification. 'auto' calibrates the highest-throughput batch size that fits in memory on the first sample."), # type: ignore
+        "subsample_size": Field(Int % Range(1, None), "The subsample size to use for classification."), # type: ignore
+        "precision": Field(Str % Choices(list(PRECISIONS)), "The Keras precision policy to run inference with. Defaults to the precision the model was trained with. Ignored for quantized models.") # type: ignore
+    },
+    outputs={"statistics": Field(FeatureData[TaxonomyStatisticsType], "The confidence sums and counts per rank and label.")} # type: ignore
+)
+def classify_taxonomy_statistics(
+    model: models.SetBERTTaxonomyModel,
+    sequences: DNAFASTAFormat,
+    frequency_table: BIOMV210Format,
+    batch_size: Union[int, Literal["auto"]] = 1,
+    subsample_size: int = 1000,
+    precision: Optional[str] = None
+) -> TaxonomyStatisticsFormat:
+    with Instrumentation("classify_taxonomy_statistics") as metrics:
+        sequence_map, frequency = _read_inputs(metrics, sequences, frequency_table)
+        statistics = _classify_samples(
+            model, sequence_map, frequency, batch_size, subsample_size, metrics=metrics, precision=precision)
+        ff = TaxonomyStatisticsFormat()
+        with metrics.stage("tsv_writing", unit="features") as stage:
+            _write_statistics(ff, statistics)
+            stage.items += len(statistics)
+    return ff
+
+@register_method(
+    "Collate taxonomy statistics",
+    description="Reduce per-shard taxonomy statistics into the final taxonomy classification.",
+    inputs={"statistics": Field(Collection[FeatureData[TaxonomyStatisticsType]], "The per-shard taxonomy statistics.")}, # type: ignore
+    parameters={
+        "confidence": Field(Float % Range(0.0, 1.0, inclusive_start=True, inclusive_end=True) | Str % Choices(['disable']), "The confidence threshold to use for classification."), # type: ignore
+    },
+    outputs={"classification": Field(FeatureData[Taxonomy], "The predicted taxonomy.")} # type: ignore
+)
+def collate_taxonomy_statistics(
+    statistics: TaxonomyStatisticsFormat,
+    confidence: Union[float, Literal["disable"]] = 0.7
+) -> TSVTaxonomyFormat:
+    with Instrumentation("collate_taxonomy_statistics") as metrics:
+        merged: TaxonomyStatistics = {}
+        with metrics.stage("aggregation", unit="shards") as stage:
+            for shard in statistics.values(): # type: ignore
+                _merge_statistics(merged, _read_statistics(shard))
+                stage.items += 1
+        ff = TSVTaxonomyFormat()
+        with metrics.stage("tsv_writing", unit="features") as stage:
+            stage.items += _write_taxonomy(ff, merged, None, confidence)
+    return ff
+
+@register_pipeline(
+    "Classify taxonomy (parallel)",
+    description="Classify sequences in parallel over sample shards of the frequency table.",
+    inputs={
+        "model": Field(DeepDNAModel[SetBERTTaxonomyModelType], "The model to use for classification."), # type: ignore
+        "sequences": Field(FeatureData[Sequence], "The sequences to classify."),
+        "frequency_table": Field(FeatureTable[Frequency], "The frequency table of the DNA sequences.")
+    },
+    parameters={
+        "confidence": Field(Float % Range(0.0, 1.0, inclusive_start=True, inclusive_end=True) | Str % Choices(['disable']), "The confidence threshold to use for classification."), # type: ignore
+        "batch_size": Field(Int % Range(1, None) | Str % Choices(['auto']), "The batch size to use for classification. 'auto' calibrates the highest-throughput batch size that fits in memory on the first sample."), # type: ignore
+        "subsample_size": Field(Int % Range(1, None), "The subsample size to use for classification."), # type: ignore
+        "num_partitions": Field(Int % Range(1, None), "The number of sample shards to classify in parallel. Each shard loads the model once. Defaults to the number of CPUs, capped at the number of samples."), # type: ignore
+        "precision": Field(Str % Choices(list(PRECISIONS)), "The Keras precision policy to run inference with. Defaults to the precision the model was trained with. Ignored for quantized models.") # type: ignore
+    },
+    outputs={"classification": Field(FeatureData[Taxonomy], "The predicted taxonomy.")} # type: ignore
+)
+def classify_taxonomy_parallel(
+    ctx,
+    model,
+    sequences,
+    frequency_table,
+    confidence=0.7,
+    batch_size=1,
+    subsample_size=1000,
+    num_partitions=None,
+    precision=None
+):
+    partition = ctx.get_action("deepdna", "partition_frequency_table")
+    classify = ctx.get_action("deepdna", "classify_taxonomy_statistics")
+    collate = ctx.get_action("deepdna", "collate_taxonomy_statistics")
+    (partitioned_tables,) = partition(frequency_table=frequency_table, num_partitions=num_partitions)
+    statistics = {}
+    for key, table in partitioned_tables.items():
+        (statistics[key],) = classify(
+            model=model,
+            sequences=sequences,
+            frequency_table=table,
+            batch_size=batch_size,
+            subsample_size=subsample_size,
+            precision=precision)
+    (classification,) = collate(statistics=statistics, confidence=confidence)
+    return classification
+
+# Inference Server Client --------------------------------------------------------------------------
+
+def _request_classification(server: str, request: dict) -> TaxonomyStatistics:
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(server)
+    except OSError as e:
+        raise ConnectionError(
+            f"No inference server is available at {server}. Start one with "
+            "`python -m q2_deepdna.server --model NAME=PATH`.") from e
+    with connection, connection.makefile("rw") as stream:
+        stream.write(json.dumps(request) + '\n')
+        stream.flush()
+        response = json.loads(stream.readline())
+    if "error" in response:
+        raise RuntimeError(f"The inference server failed to classify the samples: {response['error']}")
+    return response["statistics"]
+
+@register_method(
+    "Classify taxonomy (server)",
+    description="Classify sequences by forwarding the work to a running local inference server.",
+    inputs={
+        "sequences": Field(FeatureData[Sequence], "The sequences to classify."),
+        "frequency_table": Field(FeatureTable[Frequency], "The frequency table of the DNA sequences.")
+    },
+    parameters={
+        "model_name": Field(Str, "The name of the resident model on the server to use for classification."), # type: ignore
+        "server": Field(Str, "The Unix socket of the inference server. Defaults to $Q2_DEEPDNA_SERVER or /tmp/q2-deepdna.sock."), # type: ignore
+        "confidence": Field(Float % Range(0.0, 1.0, inclusive_start=True, inclusive_end=True) | Str % Choices(['disable']), "The confidence threshold to use for classification."), # type: ignore
+        "subsample_size": Field(Int % Range(1, None), "The subsample size to use for classification."), # type: ignore
+        "seed": Field(Int % Range(0, None), "The random seed to use for subsampling. The same seed gives the same subsamples as classify-taxonomy.") # type: ignore
+    },
+    outputs={"classification": Field(FeatureData[Taxonomy], "The predicted taxonomy.")} # type: ignore
+)
+def classify_taxonomy_remote(
+    sequences: DNAFASTAFormat,
+    frequency_table: BIOMV210Format,
+    model_name: str,
+    server: Optional[str] = None,
+    confidence: Union[float, Literal["disable"]] = 0.7,
+    subsample_size: int = 1000,
+    seed: Optional[int] = None
+) -> TSVTaxonomyFormat:
+    with Instrumentation("classify_taxonomy_remote") as metrics:
+        sequence_map, frequency = _read_inputs(metrics, sequences, frequency_table)
+        with metrics.stage("request", unit="samples") as stage:
+            statistics = _request_classification(server or DEFAULT_SERVER_SOCKET, {
+                "model": model_name,
+                "sequences": sequence_map,
+                "samples": {
+                    sample_id: {sequence_id: int(count) for sequence_id, count in row[row > 0].items()}
+                    for sample_id, row in frequency.iterrows()
+                },
+                "subsample_size": subsample_size,
+                "seed": seed
+            })
+            stage.items += len(frequency)
+        ff = TSVTaxonomyFormat()
+        with metrics.stage("tsv_writing", unit="features") as stage:
+            stage.items += _write_taxonomy(ff, statistics, frequency.columns, confidence)
     return ff
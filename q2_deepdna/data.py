@@ -1,31 +1,163 @@
+import collections
 from dnadb import fasta, taxonomy
-from q2_types.feature_data import DNAFASTAFormat, FeatureData, Sequence, Taxonomy
+from dnadb.utils import open_file
+import itertools
+import multiprocessing
+import numpy as np
+import os
+from pathlib import Path
+from qiime2.plugin import Choices, Int, Range, Str
+from q2_types.feature_data import DNAFASTAFormat, FeatureData, Sequence, Taxonomy, TSVTaxonomyFormat
 import pandas as pd
 from tqdm import tqdm
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 from .types import (
     DNAFASTADBFormat,
+    EncodedSequencesFormat,
     TaxonomyDBFormat,
+    EncodedSequences,
     SequenceDB,
     TaxonomyDB
 )
 # from .plugin_setup import plugin
 
+from ._dnadb import TaxonomyDbWriter, sequence_indices, write_fasta_entries
+from ._encoded import EncodedSequences as EncodedSequencesView
+from ._instrument import Instrumentation
+from ._memory import MemoryBudget
 from ._registry import Field, register_method
 
 
+# The size of the raw text blocks handed to parsing workers
+BLOCK_SIZE = 2**23
+
+def _write_chunk_size(budget: MemoryBudget, sequences: DNAFASTAFormat, num_samples: int = 1000) -> int:
+    """
+    Size the number of entries buffered per LMDB transaction to half of the remaining budget.
+    """
+    sample = [len(entry.serialize()) for entry in itertools.islice(fasta.entries(sequences.path), num_samples)]
+    # Each buffered entry also carries its key, its ID index entry, and Python object overhead
+    entry_bytes = 2*(max(sample, default=0) + 200)
+    budget.require(100*entry_bytes, "a write buffer of 100 sequences")
+    return int(min(max(budget.remaining() // 2 // entry_bytes, 100), 100_000))
+
+def _read_blocks(path: Union[str, Path], block_size: int = BLOCK_SIZE) -> Iterator[str]:
+    """
+    Read a (possibly gzipped) FASTA file in blocks of raw text that end on record boundaries.
+    """
+    with open_file(path) as f:
+        remainder = ""
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = remainder + data
+            end = data.rfind("\n>")
+            if end == -1:
+                remainder = data
+                continue
+            yield data[:end+1]
+            remainder = data[end+1:]
+        if remainder.strip():
+            yield remainder
+
+def _parse_block(block: str) -> List[Tuple[str, bytes]]:
+    """
+    Parse and serialize the FASTA records in a block of raw text.
+    """
+    entries = []
+    for record in ("\n" + block).split("\n>")[1:]:
+        entry = fasta.FastaEntry.from_str('>' + record)
+        entries.append((entry.identifier, entry.serialize()))
+    return entries
+
+def _parse_blocks(blocks: Iterable[str], num_workers: int) -> Iterator[List[Tuple[str, bytes]]]:
+    """
+    Parse blocks on worker processes, yielding the results in order. At most two blocks per
+    worker are in flight so that memory use does not grow with the input.
+    """
+    if num_workers == 1:
+        yield from map(_parse_block, blocks)
+        return
+    # Forking after TensorFlow has started its threads can deadlock the children
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(pool.apply_async(_parse_block, (block,)))
+            if len(pending) >= 2*num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def _estimate_map_size(path: Union[str, Path]) -> int:
+    # Entries are stored uncompressed alongside an ID index, with room for LMDB's page overhead
+    size = os.path.getsize(path) * (4 if str(path).endswith(".gz") else 1)
+    return 2*size + 2**26
+
 @register_method(
     "Sequences to DB",
     description="Convert a FeatureData[Sequence] artifact to a FeatureData[SequenceDB] artifact.",
     inputs={"sequences": Field(FeatureData[Sequence], "The sequences to use for training.")}, # type: ignore
+    parameters={
+        "max_memory": Field(Int % Range(1, None), "The memory budget in MiB used to size the write buffer."), # type: ignore
+        "num_workers": Field(Int % Range(1, None), "The number of worker processes to parse and serialize sequences on. Defaults to the number of CPUs."), # type: ignore
+        "chunk_size": Field(Int % Range(1, None), "The number of database keys written per LMDB transaction."), # type: ignore
+        "map_size": Field(Int % Range(1, None), "The initial LMDB map size in MiB. Defaults to an estimate from the input size; the map still grows if needed.") # type: ignore
+    },
     outputs={"sequences_db": Field(FeatureData[SequenceDB], "The FASTA database to use for training.")}, # type: ignore
 )
-def sequences_to_db(sequences: DNAFASTAFormat) -> DNAFASTADBFormat:
-    ff = DNAFASTADBFormat()
-    ff.path.mkdir(parents=True, exist_ok=True)
-    with fasta.FastaDbFactory(ff.path) as factory:
-        factory.write_entries(tqdm(fasta.entries(sequences.path)))
+def sequences_to_db(
+    sequences: DNAFASTAFormat,
+    max_memory: Optional[int] = None,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 100_000,
+    map_size: Optional[int] = None
+) -> DNAFASTADBFormat:
+    with Instrumentation("sequences_to_db") as metrics:
+        num_workers = num_workers or os.cpu_count() or 1
+        block_size = BLOCK_SIZE
+        budget = MemoryBudget.create(max_memory, "sequences_to_db")
+        if budget is not None:
+            chunk_size = min(chunk_size, _write_chunk_size(budget, sequences))
+            # Each in-flight block is held as text and as parsed entries
+            block_size = int(min(BLOCK_SIZE, max(budget.remaining() // 2 // (8*num_workers), 2**16)))
+            metrics.event("memory_budget", max_memory_mb=max_memory, chunk_size=chunk_size, block_size=block_size)
+        ff = DNAFASTADBFormat()
+        ff.path.mkdir(parents=True, exist_ok=True)
+        with metrics.stage("ingestion", unit="sequences") as stage, fasta.FastaDbFactory(ff.path, chunk_size=chunk_size) as factory:
+            # Presize the map so that large inputs do not repeatedly double and retry transactions
+            factory.db.map_size = map_size*2**20 if map_size is not None else _estimate_map_size(sequences.path)
+            with tqdm(unit="seq") as progress:
+                for entries in _parse_blocks(_read_blocks(sequences.path, block_size), num_workers):
+                    write_fasta_entries(factory, entries)
+                    progress.update(len(entries))
+            stage.items += int(factory.num_entries)
     return ff
 
+def _read_taxonomy(path: Union[str, Path], chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Stream the (feature ID, taxon) columns of a taxonomy TSV in chunks.
+    """
+    chunks = pd.read_csv(
+        path, sep="\t", header=0, usecols=[0, 1], names=["id", "taxon"], dtype=str,
+        keep_default_na=False, skip_blank_lines=True, chunksize=chunk_size)
+    for chunk in chunks:
+        chunk["taxon"] = chunk["taxon"].str.strip()
+        yield chunk
+
+def _reject_duplicates(seen: np.ndarray, sequence_ids: List[str], indices: np.ndarray):
+    """
+    Mark a chunk's sequences as seen, rejecting feature IDs that occur more than once.
+    """
+    _, first = np.unique(indices, return_index=True)
+    repeated = np.ones(len(indices), dtype=bool)
+    repeated[first] = False
+    repeated |= seen[indices]
+    if repeated.any():
+        duplicates = sorted({sequence_ids[i] for i in np.flatnonzero(repeated)})
+        raise ValueError(f"The taxonomy contains duplicate feature IDs, e.g. {duplicates[:5]}")
+    seen[indices] = True
+
 @register_method(
     "Taxonomy to DB",
     description="Convert a FeatureData[Taxonomy] artifact to a FeatureData[TaxonomyDB] artifact.",
@@ -33,14 +165,67 @@ def sequences_to_db(sequences: DNAFASTAFormat) -> DNAFASTADBFormat:
         "sequences_db": Field(FeatureData[SequenceDB], "The sequences to corresponding to the taxonomies."), # type: ignore
         "taxonomies": Field(FeatureData[Taxonomy], "The taxonomies corresponding to the given sequences DB") # type: ignore
     },
+    parameters={
+        "chunk_size": Field(Int % Range(1, None), "The number of taxonomy rows read, and database keys written, at a time.") # type: ignore
+    },
     outputs={"taxonomy_db": Field(FeatureData[TaxonomyDB], "The taxonomy database.")}, # type: ignore
 )
-def taxonomy_to_db(sequences_db: fasta.FastaDb, taxonomies: pd.DataFrame) -> TaxonomyDBFormat:
-    ff = TaxonomyDBFormat()
-    ff.path.mkdir(parents=True, exist_ok=True)
-    with taxonomy.TaxonomyDbFactory(ff.path, fasta_db=sequences_db) as factory:
-        for sequence_id, taxon in tqdm(taxonomies.itertuples(index=True), total=len(taxonomies)):
-            factory.write_sequence(sequence_id, taxon)
+def taxonomy_to_db(
+    sequences_db: fasta.FastaDb,
+    taxonomies: TSVTaxonomyFormat,
+    chunk_size: int = 100_000
+) -> TaxonomyDBFormat:
+    with Instrumentation("taxonomy_to_db") as metrics:
+        ff = TaxonomyDBFormat()
+        ff.path.mkdir(parents=True, exist_ok=True)
+        # The taxonomy IDs depend on every label, so the labels are interned in a first pass
+        with metrics.stage("tree_building", unit="labels") as stage:
+            tree_factory = taxonomy.TaxonomyTreeFactory()
+            labels = set()
+            for chunk in _read_taxonomy(taxonomies.path, chunk_size):
+                labels.update(chunk["taxon"].unique())
+            for label in labels:
+                tree_factory.add_label(label)
+            tree = tree_factory.build()
+            taxonomy_ids = {label: tree.taxonomy(label).taxonomy_id for label in labels}
+            stage.items += len(labels)
+        del labels
+        with metrics.stage("ingestion", unit="sequences") as stage, TaxonomyDbWriter(ff.path, sequences_db, tree, chunk_size) as writer:
+            # Reading the TSV in chunks skips q2_types' check for duplicate feature IDs
+            seen = np.zeros(len(sequences_db), dtype=bool)
+            with tqdm(unit="seq") as progress:
+                for chunk in _read_taxonomy(taxonomies.path, chunk_size):
+                    sequence_ids = chunk["id"].tolist()
+                    indices = sequence_indices(sequences_db, sequence_ids)
+                    _reject_duplicates(seen, sequence_ids, indices)
+                    ids = chunk["taxon"].map(taxonomy_ids).to_numpy(dtype=np.int32)
+                    writer.write_sequences(sequence_ids, chunk["taxon"].tolist(), indices, ids)
+                    stage.items += len(chunk)
+                    progress.update(len(chunk))
     return ff
 
-
+@register_method(
+    "Encode sequences DB",
+    description="Encode the sequences of a FeatureData[SequenceDB] artifact once into memory-mapped arrays for fast sampling during pre-training.",
+    inputs={"sequences_db": Field(FeatureData[SequenceDB], "The sequences to encode.")}, # type: ignore
+    parameters={
+        "packing": Field(Str % Choices(["uint8", "2bit"]), "Store one base per byte, or four per byte. Two-bit packing resolves ambiguous bases once at random instead of for every sample."), # type: ignore
+        "max_length": Field(Int % Range(1, None), "Truncate sequences to this many bases. Defaults to keeping whole sequences."), # type: ignore
+        "shard_size": Field(Int % Range(1, None), "The number of sequences per shard.") # type: ignore
+    },
+    outputs={"encoded_sequences": Field(FeatureData[EncodedSequences], "The encoded sequences.")}, # type: ignore
+)
+def encode_sequences_db(
+    sequences_db: fasta.FastaDb,
+    packing: str = "uint8",
+    max_length: Optional[int] = None,
+    shard_size: int = 100_000
+) -> EncodedSequencesFormat:
+    with Instrumentation("encode_sequences_db") as metrics:
+        ff = EncodedSequencesFormat()
+        ff.path.mkdir(parents=True, exist_ok=True)
+        with metrics.stage("encoding", unit="sequences") as stage, tqdm(total=len(sequences_db), unit="seq") as progress:
+            for written in EncodedSequencesView.write(ff.path, sequences_db, packing, max_length, shard_size):
+                stage.items += written
+                progress.update(written)
+    return ff
@@ -0,0 +1,181 @@
+from dnadb import fasta, taxonomy
+import numpy as np
+from qiime2.plugin import Bool, Int, Range
+from q2_types.feature_data import FeatureData
+import tensorflow as tf
+from typing import Type, TypeVar
+from . import models
+from ._instrument import Instrumentation
+from ._profile import tracing_counts
+from ._registry import Field, register_method
+from .types import (
+    DeepDNAModel,
+    DNABERTBERTaxTaxonomyModel as DNABERTBERTaxTaxonomyModelType,
+    DNABERTNaiveTaxonomyModel as DNABERTNaiveTaxonomyModelType,
+    DNABERTTopDownTaxonomyModel as DNABERTTopDownTaxonomyModelType,
+    SequenceDB,
+    TaxonomyDB
+)
+
+StudentType = TypeVar(
+    "StudentType",
+    models.DNABERTNaiveTaxonomyModel,
+    models.DNABERTBERTaxTaxonomyModel,
+    models.DNABERTTopDownTaxonomyModel)
+
+DISTILLATION_PARAMETERS = {
+    # Student hyperparameters
+    "student_embed_dim": Field(Int % Range(1, None), "The embedding dimension of the student."), # type: ignore
+    "student_num_transformer_blocks": Field(Int % Range(1, None), "The number of transformer blocks of the student."), # type: ignore
+    "student_num_attention_heads": Field(Int % Range(1, None), "The number of attention heads within each transformer block of the student."), # type: ignore
+
+    # Training hyperparameters
+    "train_epochs": Field(Int % Range(1, None), "The number of epochs to be used for training."), # type: ignore
+    "train_steps_per_epoch": Field(Int % Range(1, None), "The number of steps per epoch to be used for training."), # type: ignore
+    "train_batch_size": Field(Int % Range(1, None), "The batch size to be used for training."), # type: ignore
+    "train_show_progress": Field(Bool, "Whether to show the training progress or not (--verbose required)."),
+}
+
+
+def _distill(
+    action: str,
+    student_type: Type[StudentType],
+    teacher: models.DeepDNAModel,
+    sequences_db: fasta.FastaDb,
+    taxonomy_db: taxonomy.TaxonomyDb,
+    student_embed_dim: int,
+    student_num_transformer_blocks: int,
+    student_num_attention_heads: int,
+    train_epochs: int,
+    train_steps_per_epoch: int,
+    train_batch_size: int,
+    train_show_progress: bool
+) -> StudentType:
+    with Instrumentation(action) as metrics:
+        with metrics.stage("model_creation", unit="models") as stage:
+            # The student reads the same k-mer sequences as the teacher
+            sequence_length, kmer, kmer_stride = teacher.tokenization()
+            pretraining_model = models.DNABERTPretrainingModel.create(
+                sequence_length=sequence_length,
+                kmer=kmer,
+                embed_dim=student_embed_dim,
+                stack=student_num_transformer_blocks,
+                num_heads=student_num_attention_heads,
+                kmer_stride=kmer_stride)
+            student = student_type.create(pretraining_model, taxonomy_db.tree)
+            student.manifest.config["distillation"] = {"teacher": teacher.manifest.config.get("model")}
+            x = np.zeros((1, models.num_tokens(sequence_length, kmer, kmer_stride)), dtype=np.int64)
+            teacher_shapes = [tuple(y.shape) for y in tf.nest.flatten(teacher.model(x))]
+            student_shapes = [tuple(y.shape) for y in tf.nest.flatten(student.model(x))]
+            if teacher_shapes != student_shapes:
+                raise ValueError(
+                    f"The student's outputs {student_shapes} do not match the teacher's {teacher_shapes}. "
+                    "The taxonomy DB must use the same taxonomy as the teacher was trained on.")
+            stage.items += 1
+        student.summary()
+        with metrics.stage("training", unit="sequences") as stage:
+            history = models.distill(
+                teacher,
+                student,
+                sequences_db,
+                epochs=train_epochs,
+                steps_per_epoch=train_steps_per_epoch,
+                batch_size=train_batch_size,
+                verbose=1 if train_show_progress else 0)
+            stage.items += len(history.epoch) * train_steps_per_epoch * train_batch_size
+        metrics.event("distillation", teacher_parameters=teacher.model.count_params(), student_parameters=student.model.count_params())
+        metrics.event("tracing", **tracing_counts(student.model))
+    return student
+
+
+@register_method(
+    "Distill DNABERT naive taxonomy model",
+    description="Distill a DNABERT naive taxonomy model into a smaller student of the same type.",
+    inputs={
+        "teacher": Field(DeepDNAModel[DNABERTNaiveTaxonomyModelType], "The trained teacher model."), # type: ignore
+        "sequences_db": Field(FeatureData[SequenceDB], "The sequences to distill on."), # type: ignore
+        "taxonomy_db": Field(FeatureData[TaxonomyDB], "The taxonomy the teacher was trained on."), # type: ignore
+    },
+    parameters=DISTILLATION_PARAMETERS,
+    outputs={"student": Field(DeepDNAModel[DNABERTNaiveTaxonomyModelType], "The distilled student model.")}, # type: ignore
+)
+def distill_dnabert_naive_taxonomy(
+    teacher: models.DNABERTNaiveTaxonomyModel,
+    sequences_db: fasta.FastaDb,
+    taxonomy_db: taxonomy.TaxonomyDb,
+    # Student hyperparameters
+    student_embed_dim: int = 32,
+    student_num_transformer_blocks: int = 4,
+    student_num_attention_heads: int = 4,
+    # Training hyperparameters
+    train_epochs: int = 100,
+    train_steps_per_epoch: int = 100,
+    train_batch_size: int = 256,
+    train_show_progress: bool = True
+) -> models.DNABERTNaiveTaxonomyModel:
+    return _distill(
+        "distill_dnabert_naive_taxonomy", models.DNABERTNaiveTaxonomyModel, teacher, sequences_db, taxonomy_db,
+        student_embed_dim, student_num_transformer_blocks, student_num_attention_heads,
+        train_epochs, train_steps_per_epoch, train_batch_size, train_show_progress)
+
+
+@register_method(
+    "Distill DNABERT BERTax taxonomy model",
+    description="Distill a DNABERT BERTax taxonomy model into a smaller student of the same type.",
+    inputs={
+        "teacher": Field(DeepDNAModel[DNABERTBERTaxTaxonomyModelType], "The trained teacher model."), # type: ignore
+        "sequences_db": Field(FeatureData[SequenceDB], "The sequences to distill on."), # type: ignore
+        "taxonomy_db": Field(FeatureData[TaxonomyDB], "The taxonomy the teacher was trained on."), # type: ignore
+    },
+    parameters=DISTILLATION_PARAMETERS,
+    outputs={"student": Field(DeepDNAModel[DNABERTBERTaxTaxonomyModelType], "The distilled student model.")}, # type: ignore
+)
+def distill_dnabert_bertax_taxonomy(
+    teacher: models.DNABERTBERTaxTaxonomyModel,
+    sequences_db: fasta.FastaDb,
+    taxonomy_db: taxonomy.TaxonomyDb,
+    # Student hyperparameters
+    student_embed_dim: int = 32,
+    student_num_transformer_blocks: int = 4,
+    student_num_attention_heads: int = 4,
+    # Training hyperparameters
+    train_epochs: int = 100,
+    train_steps_per_epoch: int = 100,
+    train_batch_size: int = 256,
+    train_show_progress: bool = True
+) -> models.DNABERTBERTaxTaxonomyModel:
+    return _distill(
+        "distill_dnabert_bertax_taxonomy", models.DNABERTBERTaxTaxonomyModel, teacher, sequences_db, taxonomy_db,
+        student_embed_dim, student_num_transformer_blocks, student_num_attention_heads,
+        train_epochs, train_steps_per_epoch, train_batch_size, train_show_progress)
+
+
+@register_method(
+    "Distill DNABERT top-down taxonomy model",
+    description="Distill a DNABERT top-down taxonomy model into a smaller student of the same type.",
+    inputs={
+        "teacher": Field(DeepDNAModel[DNABERTTopDownTaxonomyModelType], "The trained teacher model."), # type: ignore
+        "sequences_db": Field(FeatureData[SequenceDB], "The sequences to distill on."), # type: ignore
+        "taxonomy_db": Field(FeatureData[TaxonomyDB], "The taxonomy the teacher was trained on."), # type: ignore
+    },
+    parameters=DISTILLATION_PARAMETERS,
+    outputs={"student": Field(DeepDNAModel[DNABERTTopDownTaxonomyModelType], "The distilled student model.")}, # type: ignore
+)
+def distill_dnabert_topdown_taxonomy(
+    teacher: models.DNABERTTopDownTaxonomyModel,
+    sequences_db: fasta.FastaDb,
+    taxonomy_db: taxonomy.TaxonomyDb,
+    # Student hyperparameters
+    student_embed_dim: int = 32,
+    student_num_transformer_blocks: int = 4,
+    student_num_attention_heads: int = 4,
+    # Training hyperparameters
+    train_epochs: int = 100,
+    train_steps_per_epoch: int = 100,
+    train_batch_size: int = 256,
+    train_show_progress: bool = True
+) -> models.DNABERTTopDownTaxonomyModel:
+    return _distill(
+        "distill_dnabert_topdown_taxonomy", models.DNABERTTopDownTaxonomyModel, teacher, sequences_db, taxonomy_db,
+        student_embed_dim, student_num_transformer_blocks, student_num_attention_heads,
+        train_epochs, train_steps_per_epoch, train_batch_size, train_show_progress)
@@ -0,0 +1,121 @@
+from dnadb import dna, fasta
+import numpy as np
+from qiime2.plugin import Bool, Choices, Float, Int, List, Range, Str
+from q2_types.feature_data import DNAFASTAFormat, FeatureData, Sequence, Taxonomy, TSVTaxonomyFormat
+import typing
+from typing import Literal, Union
+from . import models
+from .classify import TaxonomyStatistics, _accumulate, _read_sequences, _write_taxonomy
+from ._early_exit import EarlyExitHeads, train_exit_heads, use_early_exit
+from ._instrument import Instrumentation
+from ._profile import Profiler, ProfilerCallback
+from ._registry import Field, register_method
+from .models import _sequence_batches
+from .types import DeepDNAModel, DNABERTTopDownTaxonomyModel as DNABERTTopDownTaxonomyModelType, SequenceDB
+
+
+@register_method(
+    "Train early-exit heads",
+    description="Attach lightweight exit heads to intermediate transformer blocks of a DNABERT top-down taxonomy model.",
+    inputs={
+        "model": Field(DeepDNAModel[DNABERTTopDownTaxonomyModelType], "The trained taxonomy model."), # type: ignore
+        "sequences_db": Field(FeatureData[SequenceDB], "The sequences to train the exit heads on."), # type: ignore
+    },
+    parameters={
+        "exit_blocks": Field(List[Int % Range(1, None)], "The transformer blocks (1-indexed) to attach exit heads after. At least one is required."), # type: ignore
+        "train_epochs": Field(Int % Range(1, None), "The number of epochs to be used for training."), # type: ignore
+        "train_steps_per_epoch": Field(Int % Range(1, None), "The number of steps per epoch to be used for training."), # type: ignore
+        "train_batch_size": Field(Int % Range(1, None), "The batch size to be used for training."), # type: ignore
+        "train_show_progress": Field(Bool, "Whether to show the training progress or not (--verbose required)."),
+    },
+    outputs={"early_exit_model": Field(DeepDNAModel[DNABERTTopDownTaxonomyModelType], "The taxonomy model with trained exit heads.")}, # type: ignore
+)
+def train_early_exit_heads(
+    model: models.DNABERTTopDownTaxonomyModel,
+    sequences_db: fasta.FastaDb,
+    exit_blocks: typing.List[int],
+    train_epochs: int = 20,
+    train_steps_per_epoch: int = 100,
+    train_batch_size: int = 256,
+    train_show_progress: bool = True
+) -> models.DNABERTTopDownTaxonomyModel:
+    with Instrumentation("train_early_exit_heads") as metrics:
+        sequence_length, kmer, kmer_stride = model.tokenization()
+        with metrics.stage("model_creation", unit="heads") as stage:
+            x = np.zeros((1, models.num_tokens(sequence_length, kmer, kmer_stride)), dtype=np.int64)
+            heads = EarlyExitHeads.create(model.model, sorted(exit_blocks), x)
+            stage.items += len(heads.heads)
+        callbacks = []
+        profiler = Profiler.from_environment()
+        if profiler is not None:
+            callbacks.append(ProfilerCallback(profiler))
+        with metrics.stage("training", unit="sequences") as stage:
+            train_data = _sequence_batches(
+                sequences_db, train_batch_size, train_steps_per_epoch, sequence_length, kmer, kmer_stride)
+            history = train_exit_heads(
+                heads, train_data, train_epochs, callbacks, verbose=1 if train_show_progress else 0)
+            stage.items += len(history.epoch) * train_steps_per_epoch * train_batch_size
+        model.manifest.config["early_exit"] = {
+            **heads.get_config(),
+            "train": {
+                "sequences_uuid": sequences_db.uuid,
+                "epochs": train_epochs,
+                "steps_per_epoch": train_steps_per_epoch,
+                "batch_size": train_batch_size
+            }
+        }
+        model.exit_heads = heads.get_weights()
+    return model
+
+
+@register_method(
+    "Classify taxonomy (early exit)",
+    description="Classify individual sequences with a DNABERT top-down taxonomy model, stopping at the first exit head that is confident enough.",
+    inputs={
+        "model": Field(DeepDNAModel[DNABERTTopDownTaxonomyModelType], "A taxonomy model with trained exit heads."), # type: ignore
+        "sequences": Field(FeatureData[Sequence], "The sequences to classify."),
+    },
+    parameters={
+        "confidence": Field(Float % Range(0.0, 1.0, inclusive_start=True, inclusive_end=True) | Str % Choices(['disable']), "The confidence threshold to use for classification."), # type: ignore
+        "exit_threshold": Field(Float % Range(0.0, 1.0, inclusive_start=False, inclusive_end=True), "The confidence an exit head needs at the exit rank for a sequence to stop early."), # type: ignore
+        "exit_rank": Field(Int % Range(0, None), "The rank (0-indexed) whose confidence decides an early exit. Defaults to genus in a 7-rank taxonomy."), # type: ignore
+        "batch_size": Field(Int % Range(1, None), "The batch size to use for classification.") # type: ignore
+    },
+    outputs={"classification": Field(FeatureData[Taxonomy], "The predicted taxonomy.")} # type: ignore
+)
+def classify_taxonomy_early_exit(
+    model: models.DNABERTTopDownTaxonomyModel,
+    sequences: DNAFASTAFormat,
+    confidence: Union[float, Literal["disable"]] = 0.7,
+    exit_threshold: float = 0.9,
+    exit_rank: int = 5,
+    batch_size: int = 512
+) -> TSVTaxonomyFormat:
+    if model.exit_heads is None:
+        raise ValueError("The model has no exit heads. Train them with train-early-exit-heads first.")
+    with Instrumentation("classify_taxonomy_early_exit") as metrics:
+        sequence_length, kmer, kmer_stride = model.tokenization()
+        heads = EarlyExitHeads.from_config(model.model, model.manifest.config["early_exit"], model.exit_heads)
+        exits = use_early_exit(heads, exit_threshold, min(exit_rank, len(heads.output_units) - 1))
+        with metrics.stage("fasta_parsing", unit="sequences") as stage:
+            sequence_map = _read_sequences(sequences)
+            stage.items += len(sequence_map)
+        statistics: TaxonomyStatistics = {}
+        # Reads shorter than the model's sequence length cannot be encoded and are left unassigned
+        sequence_ids = [i for i, sequence in sequence_map.items() if len(sequence) >= sequence_length]
+        metrics.event("short_sequences", skipped=len(sequence_map) - len(sequence_ids), sequence_length=sequence_length)
+        for start in range(0, len(sequence_ids), batch_size):
+            batch = sequence_ids[start:start+batch_size]
+            with metrics.stage("encoding", unit="sequences") as stage:
+                x = np.array([dna.encode_sequence(sequence_map[i][:sequence_length]) for i in batch])
+                x = models.encode_kmers(x, kmer, kmer_stride)
+                stage.items += len(batch)
+            with metrics.stage("predict", unit="sequences") as stage:
+                predictions = model.model.predict(x, batch_size=batch_size, verbose=0)
+                stage.items += len(batch)
+            _accumulate(statistics, batch, predictions)
+        metrics.event("early_exit", **exits.to_dict(heads.depth))
+        ff = TSVTaxonomyFormat()
+        with metrics.stage("tsv_writing", unit="features") as stage:
+            stage.items += _write_taxonomy(ff, statistics, sequence_ids, confidence)
+    return ff
@@ -4,6 +4,7 @@ from q2_types.feature_data import FeatureData
 from q2_types.per_sample_sequences import SequencesWithQuality, PairedEndSequencesWithQuality, SingleLanePerSampleSingleEndFastqDirFmt, SingleLanePerSamplePairedEndFastqDirFmt
 from q2_types.sample_data import SampleData
 from typing import Optional, Union
+from ._instrument import Instrumentation
 from ._registry import Field, register_method
 from .models import SetBERTPretrainingModel, SetBERTClassificationModel
 from .types import DeepDNAModel, SetBERTClassificationModel as SetBERTClassificationModelType, SetBERTPretrainingModel as SetBERTPretrainingModelType, SequenceDB
@@ -55,21 +56,26 @@ def finetune_setbert_classifier(
     wandb_entity: Optional[str] = None,
     wandb_group: Optional[str] = None,
 ) -> SetBERTClassificationModel:
-    targets = {}
-    with open(metadata_file, "r") as f:
-        header = f.readline().strip().split(',')
-        i = header.index(feature)
-        for row in f:
-            row = row.strip().split(',')
-            targets[row[0]] = row[i]
-    labels = list(set(targets.values()))
-    container = SetBERTClassificationModel.create(
-        pretrained_model,
-        labels,
-    )
-    import numpy as np
-    container.model(np.zeros((1, 1000, 148), dtype=np.int64))
-    container.summary()
+    with Instrumentation("finetune_setbert_classifier") as metrics:
+        with metrics.stage("metadata_parsing", unit="samples") as stage:
+            targets = {}
+            with open(metadata_file, "r") as f:
+                header = f.readline().strip().split(',')
+                i = header.index(feature)
+                for row in f:
+                    row = row.strip().split(',')
+                    targets[row[0]] = row[i]
+            labels = list(set(targets.values()))
+            stage.items += len(targets)
+        with metrics.stage("model_creation", unit="models") as stage:
+            container = SetBERTClassificationModel.create(
+                pretrained_model,
+                labels,
+            )
+            import numpy as np
+            container.model(np.zeros((1, 1000, 148), dtype=np.int64))
+            stage.items += 1
+        container.summary()
     return container
     # wandb.init(
     #     project=wandb_project,
@@ -1,16 +1,37 @@
 from dataclasses import dataclass, field
-from typing import Any, Dict, Generic, Optional, TypeVar
+import os
+from pathlib import Path
+from typing import Any, Dict, Generic, List, Optional, Tuple, TypeVar, Union
 
 from deepdna.nn import data_generators as dg
 from deepdna.nn.callbacks import SafelyStopTrainingCallback
 from deepdna.nn.models import dnabert, setbert, taxonomy as taxonomy_models
-from dnadb import fasta, taxonomy
+from dnadb import dna, fasta, taxonomy
+import numpy as np
 import tensorflow as tf
 from typing import Iterable
 import wandb
+from ._accumulate import GradientAccumulatingAdam
+from ._checkpoint import CheckpointCallback
+from ._encoded import EncodedSequences
+from ._precision import precision_scope
+from ._profile import InputStallCallback, Profiler, ProfilerCallback
 
 ModelType = TypeVar("ModelType", bound="tf.keras.Model")
 
+def num_tokens(sequence_length: int, kmer: int, kmer_stride: int = 1) -> int:
+    """
+    The number of k-mer tokens in a sequence of the given length.
+    """
+    return (sequence_length - kmer) // kmer_stride + 1
+
+def encode_kmers(encoded_sequences, kmer: int, kmer_stride: int = 1):
+    """
+    Encode sequences into k-mer tokens taken every `kmer_stride` bases.
+    """
+    kmers = dna.encode_kmers(encoded_sequences, kmer)
+    return kmers[..., ::kmer_stride] if kmer_stride > 1 else kmers
+
 @dataclass
 class DeepDNAModelManifest:
     config: Dict[Any, Any] = field(default=dict) # type: ignore
@@ -33,10 +54,189 @@ class DeepDNAModelManifest:
 class DeepDNAModel(Generic[ModelType]):
     model: ModelType
     manifest: DeepDNAModelManifest
+    # A TFLite flatbuffer of the quantized model for CPU inference, or the path of the one in a
+    # loaded artifact. Quantized models are stored without their float Keras model, so `model` is None
+    quantized: Optional[Union[bytes, Path]] = None
+    # The weights of the early-exit heads (configured by manifest.config["early_exit"])
+    exit_heads: Optional[List[np.ndarray]] = None
 
     def summary(self):
         return self.model.summary()
 
+    def tokenization(self) -> Tuple[int, int, int]:
+        """
+        The (sequence length, k-mer size, k-mer stride) used to encode the model's inputs.
+
+        Strided models are built with a token-equivalent sequence length, so the manifest is
+        the source of truth, and every container wrapping an encoder must carry its "model"
+        configuration over. A strided encoder is indistinguishable from an overlapping one with a
+        shorter sequence length, so the fallback for manifests without one is only correct for
+        artifacts created before k-mer strides were introduced.
+        """
+        config = self.manifest.config.get("model", {})
+        if "sequence_length" in config and "kmer" in config:
+            return config["sequence_length"], config["kmer"], config.get("kmer_stride", 1)
+        base = self.model
+        while not hasattr(base, "kmer"):
+            base = base.base
+        return base.sequence_length, base.kmer, 1
+
+# Training Data ------------------------------------------------------------------------------------
+
+class EncodedSequenceBatches(tf.keras.utils.Sequence):
+    """
+    Masked-language-model batches of k-mer tokens cropped from pre-encoded sequences. Like the
+    dnadb-backed batch generators, each batch is drawn with its own seeded RNG, and the seeds
+    change between epochs when shuffling.
+    """
+    def __init__(
+        self,
+        sequences: EncodedSequences,
+        batch_size: int,
+        steps: int,
+        sequence_length: int,
+        kmer: int,
+        kmer_stride: int = 1,
+        shuffle: bool = True,
+        rng: Optional[np.random.Generator] = None
+    ):
+        self.sequences = sequences
+        self.batch_size = batch_size
+        self.steps = steps
+        self.sequence_length = sequence_length
+        self.kmer = kmer
+        self.kmer_stride = kmer_stride
+        self.shuffle = shuffle
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.seed = int(self.rng.integers(2**32))
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, index: int):
+        rng = np.random.default_rng([self.seed, index])
+        x = self.sequences.sample(self.batch_size, self.sequence_length, rng)
+        if self.sequences.packing == "uint8":
+            x = dna.replace_ambiguous_encoded_bases(x, rng)
+        x = encode_kmers(x, self.kmer, self.kmer_stride)
+        return x, x
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.seed = int(self.rng.integers(2**32))
+
+class BlockSequenceBatches(tf.keras.utils.Sequence):
+    """
+    Masked-language-model batches drawn from a shuffle buffer that is refilled by reading
+    contiguous runs of entries from the sequence DB, each starting at a random entry.
+
+    Runs are read with a single LMDB cursor in key order, so neighbouring entries share pages and
+    a run costs a few sequential reads rather than a page fault per entry. Batches are only as
+    independent as the buffer is large. Sequences shorter than the model's sequence length are
+    skipped.
+    """
+    def __init__(
+        self,
+        sequences: fasta.FastaDb,
+        batch_size: int,
+        steps: int,
+        sequence_length: int,
+        kmer: int,
+        kmer_stride: int = 1,
+        buffer_size: int = 100_000,
+        block_size: int = 1024,
+        rng: Optional[np.random.Generator] = None
+    ):
+        self.sequences = sequences
+        self.batch_size = batch_size
+        self.steps = steps
+        self.sequence_length = sequence_length
+        self.kmer = kmer
+        self.kmer_stride = kmer_stride
+        self.buffer_size = max(buffer_size, batch_size)
+        self.block_size = block_size
+        self.buffer: List[str] = []
+        self.pending: List[str] = []
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.seed = int(self.rng.integers(2**32))
+        self._pid = os.getpid()
+
+    def _read_block(self) -> List[str]:
+        """
+        Read the long enough sequences among up to block_size consecutive entries.
+        """
+        start = str(self.rng.integers(len(self.sequences))).encode()
+        block, scanned = [], 0
+        with self.sequences.db.env.begin() as txn:
+            cursor = txn.cursor()
+            cursor.set_range(start)
+            while scanned < self.block_size:
+                key = cursor.key()
+                # Entry keys are the indices, which sort before every other key
+                if not key.isdigit():
+                    cursor.first()
+                    continue
+                sequence = fasta.FastaEntry.deserialize(cursor.value()).sequence
+                if len(sequence) >= self.sequence_length:
+                    block.append(sequence)
+                scanned += 1
+                cursor.next()
+        return block
+
+    def _take(self, n: int) -> List[str]:
+        scanned = 0
+        while len(self.pending) < n:
+            self.pending += self._read_block()
+            scanned += self.block_size
+            if len(self.pending) == 0 and scanned >= len(self.sequences):
+                raise ValueError(f"No sequences are at least {self.sequence_length} bases long.")
+        taken, self.pending = self.pending[:n], self.pending[n:]
+        return taken
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, index: int):
+        if self._pid != os.getpid():
+            # Forked workers each start from the parent's state, so they derive their own streams
+            self._pid = os.getpid()
+            self.rng = np.random.default_rng([self.seed, self._pid])
+            self.buffer, self.pending = [], []
+        if len(self.buffer) == 0:
+            self.buffer = self._take(self.buffer_size)
+        slots = self.rng.choice(len(self.buffer), self.batch_size, replace=False)
+        batch = [self.buffer[slot] for slot in slots]
+        for slot, sequence in zip(slots, self._take(self.batch_size)):
+            self.buffer[slot] = sequence
+        x = np.empty((self.batch_size, self.sequence_length), dtype=np.uint8)
+        for row, sequence in zip(x, batch):
+            offset = self.rng.integers(len(sequence) - self.sequence_length + 1)
+            row[:] = dna.encode_sequence(sequence[offset:offset+self.sequence_length])
+        x = encode_kmers(dna.replace_ambiguous_encoded_bases(x, self.rng), self.kmer, self.kmer_stride)
+        return x, x
+
+    def on_epoch_end(self):
+        self.seed = int(self.rng.integers(2**32))
+
+def _per_replica_dataset(make_batches, batch_size: int) -> "tf.keras.utils.experimental.DatasetCreator":
+    """
+    Input for a multi-worker strategy. Each worker builds an endless dataset from its own batch
+    generator of per-replica batches, so every replica trains on its share of the global batch.
+    Every worker samples its own random batches, so there is no single stream to shard.
+    """
+    def dataset_fn(input_context: tf.distribute.InputContext) -> tf.data.Dataset:
+        batches = make_batches(input_context.get_per_replica_batch_size(batch_size))
+        x, _ = batches[0]
+        spec = tf.TensorSpec(x.shape, tf.as_dtype(x.dtype))
+        def generate():
+            while True:
+                for i in range(len(batches)):
+                    yield batches[i]
+                batches.on_epoch_end()
+        dataset = tf.data.Dataset.from_generator(generate, output_signature=(spec, spec))
+        return dataset.prefetch(tf.data.AUTOTUNE)
+    return tf.keras.utils.experimental.DatasetCreator(dataset_fn)
+
 # Model Definitions --------------------------------------------------------------------------------
 
 @dataclass
@@ -49,21 +249,30 @@ class DNABERTPretrainingModel(DeepDNAModel[dnabert.DnaBertPretrainModel]):
         embed_dim: int,
         stack: int,
         num_heads: int,
+        kmer_stride: int = 1,
+        precision: str = "float32"
     ) -> "DNABERTPretrainingModel":
-        model = dnabert.DnaBertPretrainModel(
-            dnabert.DnaBertModel(
-                sequence_length=sequence_length,
-                kmer=kmer,
-                embed_dim=embed_dim,
-                stack=stack,
-                num_heads=num_heads))
+        # DNABERT derives its token count from the sequence length assuming overlapping k-mers,
+        # so strided models are given the length that yields the same number of tokens.
+        with precision_scope(precision):
+            model = dnabert.DnaBertPretrainModel(
+                dnabert.DnaBertModel(
+                    sequence_length=num_tokens(sequence_length, kmer, kmer_stride) + kmer - 1,
+                    kmer=kmer,
+                    embed_dim=embed_dim,
+                    stack=stack,
+                    num_heads=num_heads))
+            # Build within the scope so that layers created lazily also take the policy
+            model(np.zeros((1, num_tokens(sequence_length, kmer, kmer_stride)), dtype=np.int32))
         return cls(model, DeepDNAModelManifest({
             "model": {
                 "sequence_length": sequence_length,
                 "kmer": kmer,
+                "kmer_stride": kmer_stride,
                 "embed_dim": embed_dim,
                 "stack": stack,
-                "num_heads": num_heads
+                "num_heads": num_heads,
+                "precision": precision
             }
         }))
 
@@ -78,8 +287,32 @@ class DNABERTPretrainingModel(DeepDNAModel[dnabert.DnaBertPretrainModel]):
             val_batch_size: int = 256,
             val_frequency: int = 20,
             val_steps: int = 20,
+            jit_compile: bool = False,
+            workers: int = 1,
+            encoded_sequences: Optional[EncodedSequences] = None,
+            sampling: str = "random",
+            shuffle_buffer_size: int = 100_000,
+            checkpoint_dir: Optional[str] = None,
+            checkpoint_frequency: int = 10,
+            accumulation_steps: int = 1,
             verbose: int = 0
     ):
+        if sampling not in ("random", "block"):
+            raise ValueError(f"Unknown sampling mode {sampling!r}, expected 'random' or 'block'.")
+        if sampling == "block" and encoded_sequences is not None:
+            raise ValueError("Block sampling reads from the sequences DB and cannot be combined with encoded sequences.")
+        # Under a multi-worker strategy the batch size is global and split evenly across replicas
+        replicas = self.model.distribute_strategy.num_replicas_in_sync
+        if batch_size % replicas != 0 or val_batch_size % replicas != 0:
+            raise ValueError(f"The batch sizes must be divisible by the number of replicas ({replicas}).")
+        if replicas > 1 and checkpoint_dir is not None:
+            raise ValueError("Checkpointing is not supported with multiple workers.")
+        if workers > 1 and checkpoint_dir is not None:
+            # The enqueuer advances the generators at the end of an epoch on its own thread, possibly
+            # before the checkpoint captures their state, so a resumed run would sample other batches
+            raise ValueError("Checkpointing cannot be combined with multiple batch preparation workers.")
+        if replicas > 1 and accumulation_steps > 1:
+            raise ValueError("Gradient accumulation is not supported with multiple workers.")
         self.manifest.config["train"] = {
             "train_sequences_uuid": train_sequences.uuid,
             "val_sequences_uuid": val_sequences.uuid if val_sequences else None,
@@ -89,37 +322,93 @@ class DNABERTPretrainingModel(DeepDNAModel[dnabert.DnaBertPretrainModel]):
             "batch_size": batch_size,
             "val_batch_size": val_batch_size,
             "val_frequency": val_frequency,
-            "val_steps": val_steps
+            "val_steps": val_steps,
+            "jit_compile": jit_compile,
+            "encoded_sequences": encoded_sequences.packing if encoded_sequences is not None else None,
+            "sampling": sampling,
+            "shuffle_buffer_size": shuffle_buffer_size if sampling == "block" else None,
+            "replicas": replicas,
+            "accumulation_steps": accumulation_steps
         }
         self.model.masking.mask_ratio.assign(mask_ratio)
-        self.model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-4))
-        train_data = dg.BatchGenerator(batch_size, steps_per_epoch, [
-            dg.random_samples(train_sequences),
-            dg.random_sequence_entries(),
-            dg.sequences(self.model.sequence_length),
-            dg.augment_ambiguous_bases(),
-            dg.encode_sequences(),
-            dg.encode_kmers(self.model.kmer),
-            lambda encoded_kmer_sequences: (encoded_kmer_sequences, encoded_kmer_sequences)
-        ])
-        val_data = dg.BatchGenerator(val_batch_size, val_steps, [
-            dg.random_samples(val_sequences or train_sequences),
-            dg.random_sequence_entries(),
-            dg.sequences(self.model.sequence_length),
-            dg.augment_ambiguous_bases(),
-            dg.encode_sequences(),
-            dg.encode_kmers(self.model.kmer),
-            lambda encoded_kmer_sequences: (encoded_kmer_sequences, encoded_kmer_sequences)
-        ], shuffle=(val_sequences is not None))
+        sequence_length, kmer, kmer_stride = self.tokenization()
+        # Batch generators always yield full batches, so the compiled train step has a fixed signature
+        if accumulation_steps > 1:
+            optimizer = GradientAccumulatingAdam(accumulation_steps, learning_rate=1e-4)
+        else:
+            optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
+        self.model.compile(optimizer=optimizer, jit_compile=jit_compile)
+        # Each epoch still makes `steps_per_epoch` optimizer updates, each over `accumulation_steps`
+        # micro-batches of `batch_size` sequences
+        micro_steps = steps_per_epoch * accumulation_steps
+
+        def train_batches(batch_size: int):
+            # Pre-encoded sequences are cropped with vectorized slicing instead of per-entry DB lookups
+            if encoded_sequences is not None:
+                return EncodedSequenceBatches(
+                    encoded_sequences, batch_size, micro_steps, sequence_length, kmer, kmer_stride)
+            if sampling == "block":
+                return BlockSequenceBatches(
+                    train_sequences, batch_size, micro_steps, sequence_length, kmer, kmer_stride,
+                    buffer_size=shuffle_buffer_size)
+            return dg.BatchGenerator(batch_size, micro_steps, [
+                dg.random_samples(train_sequences),
+                dg.random_sequence_entries(),
+                dg.sequences(sequence_length),
+                dg.augment_ambiguous_bases(),
+                dg.encode_sequences(),
+                lambda encoded_sequences: encode_kmers(encoded_sequences, kmer, kmer_stride),
+                lambda encoded_kmer_sequences: (encoded_kmer_sequences, encoded_kmer_sequences)
+            ])
+
+        def val_batches(batch_size: int):
+            if encoded_sequences is not None and val_sequences is None:
+                return EncodedSequenceBatches(
+                    encoded_sequences, batch_size, val_steps, sequence_length, kmer, kmer_stride, shuffle=False)
+            return dg.BatchGenerator(batch_size, val_steps, [
+                dg.random_samples(val_sequences or train_sequences),
+                dg.random_sequence_entries(),
+                dg.sequences(sequence_length),
+                dg.augment_ambiguous_bases(),
+                dg.encode_sequences(),
+                lambda encoded_sequences: encode_kmers(encoded_sequences, kmer, kmer_stride),
+                lambda encoded_kmer_sequences: (encoded_kmer_sequences, encoded_kmer_sequences)
+            ], shuffle=(val_sequences is not None))
+
+        if replicas > 1:
+            train_data = _per_replica_dataset(train_batches, batch_size)
+            val_data = _per_replica_dataset(val_batches, val_batch_size)
+        else:
+            train_data, val_data = train_batches(batch_size), val_batches(val_batch_size)
+        callbacks = [
+            # Listed first so that the stall time is in the logs the other callbacks receive
+            InputStallCallback(),
+            SafelyStopTrainingCallback(),
+            wandb.keras.WandbMetricsLogger(),
+        ]
+        profiler = Profiler.from_environment()
+        if profiler is not None:
+            callbacks.append(ProfilerCallback(profiler))
+        initial_epoch = 0
+        if checkpoint_dir is not None:
+            checkpoint = CheckpointCallback(
+                checkpoint_dir, self.model, [train_data], self.manifest.config, checkpoint_frequency)
+            initial_epoch = checkpoint.restore()
+            callbacks.append(checkpoint)
+        # Batch generators are Keras sequences with a seeded RNG per batch, so batches prepared on
+        # forked worker processes are the same ones the training thread would have prepared.
         return self.model.fit(
             train_data,
             validation_data=val_data,
             validation_freq=val_frequency,
             epochs=epochs,
-            callbacks=[
-                SafelyStopTrainingCallback(),
-                wandb.keras.WandbMetricsLogger(),
-            ],
+            initial_epoch=initial_epoch,
+            steps_per_epoch=micro_steps,
+            validation_steps=val_steps,
+            callbacks=callbacks,
+            workers=workers,
+            use_multiprocessing=workers > 1,
+            max_queue_size=max(10, 2*workers),
             verbose=verbose)
 
 
@@ -134,7 +423,10 @@ class DNABERTBERTaxTaxonomyModel(DeepDNAModel[taxonomy_models.BertaxTaxonomyClas
         base = dnabert_pretraining_model.model.base
         encoder = dnabert.DnaBertEncoderModel(base)
         model = taxonomy_models.BertaxTaxonomyClassificationModel(encoder, taxonomy_tree)
-        return cls(model, DeepDNAModelManifest({}))
+        # Carry over the encoder's configuration so the tokenization is known downstream
+        return cls(model, DeepDNAModelManifest({
+            "model": dict(dnabert_pretraining_model.manifest.config.get("model", {}))
+        }))
 
     def fit(
         self,
@@ -154,7 +446,9 @@ class DNABERTNaiveTaxonomyModel(DeepDNAModel[taxonomy_models.NaiveTaxonomyClassi
         base = dnabert_pretraining_model.model.base
         encoder = dnabert.DnaBertEncoderModel(base)
         model = taxonomy_models.NaiveTaxonomyClassificationModel(encoder, taxonomy_tree)
-        return cls(model, DeepDNAModelManifest({}))
+        return cls(model, DeepDNAModelManifest({
+            "model": dict(dnabert_pretraining_model.manifest.config.get("model", {}))
+        }))
 
     def fit(
         self,
@@ -173,7 +467,9 @@ class DNABERTTopDownTaxonomyModel(DeepDNAModel[taxonomy_models.TopDownTaxonomyCl
         base = dnabert_pretraining_model.model.base
         encoder = dnabert.DnaBertEncoderModel(base)
         model = taxonomy_models.TopDownTaxonomyClassificationModel(encoder, taxonomy_tree)
-        return cls(model, DeepDNAModelManifest({}))
+        return cls(model, DeepDNAModelManifest({
+            "model": dict(dnabert_pretraining_model.manifest.config.get("model", {}))
+        }))
 
     def fit(
         self,
@@ -182,6 +478,82 @@ class DNABERTTopDownTaxonomyModel(DeepDNAModel[taxonomy_models.TopDownTaxonomyCl
         return
 
 
+# Distillation -------------------------------------------------------------------------------------
+
+def _sequence_batches(
+    sequences: fasta.FastaDb,
+    batch_size: int,
+    steps: int,
+    sequence_length: int,
+    kmer: int,
+    kmer_stride: int = 1
+) -> dg.BatchGenerator:
+    """
+    Unlabeled batches of random, augmented k-mer sequences for training against a teacher.
+    """
+    return dg.BatchGenerator(batch_size, steps, [
+        dg.random_samples(sequences),
+        dg.random_sequence_entries(),
+        dg.sequences(sequence_length),
+        dg.augment_ambiguous_bases(),
+        dg.encode_sequences(),
+        lambda encoded_sequences: encode_kmers(encoded_sequences, kmer, kmer_stride),
+        lambda encoded_kmer_sequences: (encoded_kmer_sequences, encoded_kmer_sequences)
+    ])
+
+class _DistillationModel(tf.keras.Model):
+    """
+    Trains a student to match a frozen teacher's output distributions.
+    """
+    def __init__(self, teacher: tf.keras.Model, student: tf.keras.Model):
+        super().__init__()
+        self.teacher = teacher
+        self.student = student
+        self.kl_divergence = tf.keras.losses.KLDivergence()
+
+    def call(self, inputs, training=None):
+        return self.student(inputs, training=training)
+
+    def train_step(self, data):
+        x = data[0] if isinstance(data, tuple) else data
+        targets = tf.nest.flatten(self.teacher(x, training=False))
+        with tf.GradientTape() as tape:
+            outputs = tf.nest.flatten(self.student(x, training=True))
+            loss = tf.add_n([self.kl_divergence(t, y) for t, y in zip(targets, outputs)])
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+        return {"loss": loss}
+
+
+def distill(
+    teacher: DeepDNAModel,
+    student: DeepDNAModel,
+    sequences: fasta.FastaDb,
+    epochs: int = 100,
+    steps_per_epoch: int = 100,
+    batch_size: int = 256,
+    verbose: int = 0
+):
+    """
+    Train the student taxonomy model on the teacher's per-rank output distributions for
+    sequences sampled from the given database.
+    """
+    student.manifest.config["train"] = {
+        "sequences_uuid": sequences.uuid,
+        "epochs": epochs,
+        "steps_per_epoch": steps_per_epoch,
+        "batch_size": batch_size
+    }
+    train_data = _sequence_batches(sequences, batch_size, steps_per_epoch, *student.tokenization())
+    distiller = _DistillationModel(teacher.model, student.model)
+    distiller.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-4))
+    callbacks = [SafelyStopTrainingCallback()]
+    profiler = Profiler.from_environment()
+    if profiler is not None:
+        callbacks.append(ProfilerCallback(profiler))
+    return distiller.fit(train_data, epochs=epochs, callbacks=callbacks, verbose=verbose)
+
+
 @dataclass
 class SetBERTPretrainingModel(DeepDNAModel[setbert.SetBertPretrainWithTaxaAbundanceDistributionModel]):
     @classmethod
@@ -217,7 +589,10 @@ class SetBERTClassificationModel(DeepDNAModel):
     ):
         base = setbert_pretraining_model.model.base
         classifier = setbert.SetBertClassificationModel(base, labels, False)
-        return cls(classifier, DeepDNAModelManifest({}))
+        # Carry over the encoder's configuration so the tokenization is known downstream
+        return cls(classifier, DeepDNAModelManifest({
+            "model": dict(setbert_pretraining_model.manifest.config.get("model", {}))
+        }))
 
     def fit(
         self,
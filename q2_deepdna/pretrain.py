@@ -1,8 +1,13 @@
 from qiime2.plugin import Bool, Choices, Int, Float, Range, Str
 from q2_types.feature_data import FeatureData
 from typing import Optional
-from .types import DeepDNAModel, DNABERTPretrainingModel as DNABERTPretrainingModelType, SequenceDB
+from .types import DeepDNAModel, DNABERTPretrainingModel as DNABERTPretrainingModelType, EncodedSequences, SequenceDB
 from .models import DNABERTPretrainingModel
+from ._distribute import fit_distributed
+from ._encoded import EncodedSequences as EncodedSequencesView
+from ._instrument import Instrumentation
+from ._precision import PRECISIONS
+from ._profile import tracing_counts
 from ._registry import Field, register_method
 
 from dnadb import fasta
@@ -12,24 +17,37 @@ import wandb
 @register_method(
     "Pretrain DNABERT",
     description="Pre-train a DNABERT model.",
-    inputs={"sequences": Field(FeatureData[SequenceDB], "The feature sequences to be classified.")}, # type: ignore
+    inputs={
+        "sequences": Field(FeatureData[SequenceDB], "The feature sequences to be classified."), # type: ignore
+        "encoded_sequences": Field(FeatureData[EncodedSequences], "The same sequences pre-encoded with encode-sequences-db. When given, training batches are cropped from these arrays instead of read from the DB. Sequences shorter than the model's sequence length are not sampled.") # type: ignore
+    },
     parameters={
         # Model hyperparameters
         "model_sequence_length": Field(Int % Range(1, None), "The length of the sequence to be used for the model."), # type: ignore
         "model_kmer": Field(Int % Range(1, None), "The kmer size to be used for the model."), # type: ignore
+        "model_kmer_stride": Field(Int % Range(1, None), "The number of bases between consecutive k-mers. A stride equal to the k-mer size gives non-overlapping k-mers."), # type: ignore
         "model_embed_dim": Field(Int % Range(1, None), "The embedding dimension to be used for the model."), # type: ignore
         "model_num_transformer_blocks": Field(Int % Range(1, None), "The number of transformer blocks to be used for the model."), # type: ignore
         "model_num_attention_heads": Field(Int % Range(1, None), "The number of attention heads within each transformer block to be used for the model."), # type: ignore
+        "model_precision": Field(Str % Choices(list(PRECISIONS)), "The Keras precision policy of the model. mixed_bfloat16 computes in bfloat16 with float32 weights, which is faster on CPUs with native bfloat16 support."), # type: ignore
 
         # Training hyperparameters
         "train_epochs": Field(Int % Range(1, None), "The number of epochs to be used for training."), # type: ignore
         "train_steps_per_epoch": Field(Int % Range(1, None), "The number of steps per epoch to be used for training."), # type: ignore
         "train_batch_size": Field(Int % Range(1, None), "The batch size to be used for training."), # type: ignore
+        "train_accumulation_steps": Field(Int % Range(1, None), "The number of batches to accumulate gradients over before each optimizer update. The effective batch size is the batch size times this number, while memory use stays that of a single batch."), # type: ignore
         "train_mask_ratio": Field(Float % Range(0, 1, inclusive_start=False, inclusive_end=False), "The ratio of the sequences to be masked during pre-training."), # type: ignore
         "train_val_batch_size": Field(Int % Range(1, None), "The batch size to be used for validation."), # type: ignore
         "train_val_frequency": Field(Int % Range(1, None), "The validation frequency to use for training."), # type: ignore
         "train_val_steps": Field(Int % Range(1, None), "The number of steps to use for validation."), # type: ignore
         "train_show_progress": Field(Bool, "Whether to show the training progress or not (--verbose required)."),
+        "train_jit_compile": Field(Bool, "Compile the training step with XLA."),
+        "train_workers": Field(Int % Range(1, None), "The number of worker processes preparing training batches in parallel with training."), # type: ignore
+        "train_sampling": Field(Str % Choices(["random", "block"]), "Draw each training sequence from a random DB entry, or stream contiguous runs of entries from random offsets through a shuffle buffer for better I/O locality."), # type: ignore
+        "train_shuffle_buffer_size": Field(Int % Range(1, None), "The number of sequences in the shuffle buffer for block sampling."), # type: ignore
+        "train_checkpoint_dir": Field(Str, "A directory to periodically checkpoint training to. Running the action again with the same directory and parameters resumes from the latest checkpoint. Requires a single training worker."),
+        "train_checkpoint_frequency": Field(Int % Range(1, None), "The number of epochs between checkpoints."), # type: ignore
+        "train_distributed_workers": Field(Int % Range(1, None), "The number of local processes to train data-parallel across, each with an equal share of the CPUs. The batch sizes are global and must be divisible by this number."), # type: ignore
 
         # Wandb
         "wandb_mode": Field(Str % Choices(["disabled", "online", "offline"]), "The wandb mode to be used for logging."), # type: ignore
@@ -42,21 +60,32 @@ import wandb
 )
 def pretrain_dnabert(
     sequences: fasta.FastaDb,
+    encoded_sequences: Optional[EncodedSequencesView] = None,
     # Model hyperparameters
     model_sequence_length: int = 150,
     model_kmer: int = 3,
+    model_kmer_stride: int = 1,
     model_embed_dim: int = 64,
     model_num_transformer_blocks: int = 8,
     model_num_attention_heads: int = 8,
+    model_precision: str = "float32",
     # Training hyperparameters
     train_epochs: int = 2000,
     train_steps_per_epoch: int = 100,
     train_mask_ratio: float = 0.15,
     train_batch_size: int = 256,
+    train_accumulation_steps: int = 1,
     train_val_batch_size: int = 256,
     train_val_frequency: int = 20,
     train_val_steps: int = 20,
     train_show_progress: bool = True,
+    train_jit_compile: bool = False,
+    train_workers: int = 1,
+    train_sampling: str = "random",
+    train_shuffle_buffer_size: int = 100_000,
+    train_checkpoint_dir: Optional[str] = None,
+    train_checkpoint_frequency: int = 10,
+    train_distributed_workers: int = 1,
     # Wandb
     wandb_mode: str = "disabled",
     wandb_project: Optional[str] = None,
@@ -64,29 +93,84 @@ def pretrain_dnabert(
     wandb_entity: Optional[str] = None,
     wandb_group: Optional[str] = None,
 ) -> DNABERTPretrainingModel:
-    container = DNABERTPretrainingModel.create(
-        sequence_length=model_sequence_length,
-        kmer=model_kmer,
-        embed_dim=model_embed_dim,
-        stack=model_num_transformer_blocks,
-        num_heads=model_num_attention_heads)
-    container.summary()
-    wandb.init(
-        project=wandb_project,
-        name=wandb_name,
-        entity=wandb_entity,
-        group=wandb_group,
-        mode=wandb_mode,
-        config=container.manifest.to_dict())
-    container.fit(
-        sequences,
-        val_sequences=None,
-        epochs=train_epochs,
-        steps_per_epoch=train_steps_per_epoch,
-        mask_ratio=train_mask_ratio,
-        batch_size=train_batch_size,
-        val_batch_size=train_val_batch_size,
-        val_frequency=train_val_frequency,
-        val_steps=train_val_steps,
-        verbose=1 if train_show_progress else 0)
+    if encoded_sequences is not None and encoded_sequences.sequences_uuid != str(sequences.uuid):
+        raise ValueError("The encoded sequences were not encoded from the given sequences DB.")
+    with Instrumentation("pretrain_dnabert") as metrics:
+        with metrics.stage("model_creation", unit="models") as stage:
+            container = DNABERTPretrainingModel.create(
+                sequence_length=model_sequence_length,
+                kmer=model_kmer,
+                embed_dim=model_embed_dim,
+                stack=model_num_transformer_blocks,
+                num_heads=model_num_attention_heads,
+                kmer_stride=model_kmer_stride,
+                precision=model_precision)
+            stage.items += 1
+        container.summary()
+        wandb_kwargs = dict(
+            project=wandb_project,
+            name=wandb_name,
+            entity=wandb_entity,
+            group=wandb_group,
+            mode=wandb_mode,
+            config=container.manifest.to_dict())
+        fit_kwargs = dict(
+            epochs=train_epochs,
+            steps_per_epoch=train_steps_per_epoch,
+            mask_ratio=train_mask_ratio,
+            batch_size=train_batch_size,
+            accumulation_steps=train_accumulation_steps,
+            val_batch_size=train_val_batch_size,
+            val_frequency=train_val_frequency,
+            val_steps=train_val_steps,
+            jit_compile=train_jit_compile,
+            workers=train_workers,
+            sampling=train_sampling,
+            shuffle_buffer_size=train_shuffle_buffer_size,
+            verbose=1 if train_show_progress else 0)
+        with metrics.stage("training", unit="sequences") as stage:
+            if train_distributed_workers > 1:
+                if train_checkpoint_dir is not None:
+                    raise ValueError("Checkpointing is not supported with multiple distributed workers.")
+                if train_accumulation_steps > 1:
+                    raise ValueError("Gradient accumulation is not supported with multiple distributed workers.")
+                # The workers log to wandb themselves
+                history = fit_distributed(
+                    container,
+                    train_distributed_workers,
+                    str(sequences.path),
+                    str(encoded_sequences.path) if encoded_sequences is not None else None,
+                    fit_kwargs,
+                    wandb_kwargs)
+            else:
+                wandb.init(**wandb_kwargs)
+                history = container.fit(
+                    sequences,
+                    val_sequences=None,
+                    encoded_sequences=encoded_sequences,
+                    checkpoint_dir=train_checkpoint_dir,
+                    checkpoint_frequency=train_checkpoint_frequency,
+                    **fit_kwargs)
+            stage.items += len(history.epoch) * train_steps_per_epoch * train_batch_size * train_accumulation_steps
+        if train_checkpoint_dir is not None:
+            metrics.event(
+                "checkpoint",
+                directory=train_checkpoint_dir,
+                resumed_from_epoch=history.epoch[0] if history.epoch else train_epochs)
+        stalls = history.history.get("input_stall_time", [])
+        metrics.event(
+            "input_pipeline",
+            workers=train_workers,
+            total_stall_s=round(sum(stalls), 3),
+            mean_epoch_stall_s=round(sum(stalls) / len(stalls), 4) if stalls else None,
+            max_epoch_stall_s=round(max(stalls), 4) if stalls else None)
+        if train_distributed_workers > 1:
+            metrics.event(
+                "distributed",
+                workers=train_distributed_workers,
+                sequences=history.sequences,
+                wall_time_s=round(history.wall_time, 3),
+                sequences_per_s=round(history.sequences / history.wall_time, 1))
+        else:
+            metrics.event("tracing", **tracing_counts(container.model))
     return container
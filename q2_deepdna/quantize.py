@@ -0,0 +1,118 @@
+import copy
+import json
+import numpy as np
+import pandas as pd
+from qiime2.plugin import Choices, Float, Int, Range, Str
+from q2_types.feature_data import DNAFASTAFormat, FeatureData, Sequence, Taxonomy
+from q2_types.feature_table import BIOMV210Format, Frequency, FeatureTable
+import tensorflow as tf
+from typing import Dict, Literal, Optional, Tuple, Union
+from . import models
+from .classify import _assign, _classify_samples, _embedding_width, _read_inputs
+from ._instrument import Instrumentation
+from ._quantize import QUANTIZATION_MODES, quantize
+from ._registry import Field, register_method
+from .types import DeepDNAModel, SetBERTTaxonomyModel as SetBERTTaxonomyModelType
+
+
+def _held_out_taxonomy(
+    model: models.SetBERTTaxonomyModel,
+    sequence_map: Dict[str, str],
+    frequency: pd.DataFrame,
+    batch_size: int,
+    subsample_size: int,
+    seed: int,
+    confidence: Union[float, Literal["disable"]]
+) -> Tuple[Dict[str, str], float]:
+    """
+    Classify the held-out samples, returning the assigned taxon of each feature and the inference
+    throughput in subsample sets per second.
+    """
+    run = Instrumentation("held_out", destination="off")
+    statistics = _classify_samples(model, sequence_map, frequency, batch_size, subsample_size, seed=seed, metrics=run)
+    predict = run.stages["predict"]
+    assignments = {sequence_id: _assign(ranks, confidence)[0] for sequence_id, ranks in statistics.items()}
+    return assignments, predict.items / predict.wall_time
+
+
+def _accuracy(assignments: Dict[str, str], reference: pd.Series) -> float:
+    feature_ids = [sequence_id for sequence_id in assignments if sequence_id in reference.index]
+    if len(feature_ids) == 0:
+        return float("nan")
+    return float(np.mean([assignments[sequence_id] == reference[sequence_id] for sequence_id in feature_ids]))
+
+
+@register_method(
+    "Quantize taxonomy model",
+    description="Convert a SetBERT taxonomy model into a quantized inference-only model for faster CPU inference, and evaluate it against the float model on held-out samples. The quantized artifact does not contain the float model.",
+    inputs={
+        "model": Field(DeepDNAModel[SetBERTTaxonomyModelType], "The trained taxonomy model to quantize."), # type: ignore
+        "sequences": Field(FeatureData[Sequence], "The held-out sequences to evaluate the quantized model on."),
+        "frequency_table": Field(FeatureTable[Frequency], "The frequency table of the held-out sequences."),
+        "reference_taxonomy": Field(FeatureData[Taxonomy], "The true taxonomy of the held-out sequences. When omitted, only the agreement with the float model is reported.")
+    },
+    parameters={
+        "mode": Field(Str % Choices(list(QUANTIZATION_MODES)), "Quantize the weights to int8 (dynamic range) or float16, or keep them float32. Processes classifying with the same int8 or float32 artifact share one memory-mapped copy of its weights."), # type: ignore
+        "confidence": Field(Float % Range(0.0, 1.0, inclusive_start=True, inclusive_end=True) | Str % Choices(['disable']), "The confidence threshold to use for the held-out evaluation."), # type: ignore
+        "batch_size": Field(Int % Range(1, None), "The batch size to use for the held-out evaluation."), # type: ignore
+        "subsample_size": Field(Int % Range(1, None), "The subsample size to use for the held-out evaluation."), # type: ignore
+        "seed": Field(Int % Range(0, None), "The random seed to use for subsampling. Both models see identical subsample sets.") # type: ignore
+    },
+    outputs={"quantized_model": Field(DeepDNAModel[SetBERTTaxonomyModelType], "The quantized taxonomy model and its evaluation.")} # type: ignore
+)
+def quantize_taxonomy_model(
+    model: models.SetBERTTaxonomyModel,
+    sequences: DNAFASTAFormat,
+    frequency_table: BIOMV210Format,
+    reference_taxonomy: Optional[pd.Series] = None,
+    mode: str = "int8",
+    confidence: Union[float, Literal["disable"]] = 0.7,
+    batch_size: int = 1,
+    subsample_size: int = 1000,
+    seed: int = 0
+) -> models.SetBERTTaxonomyModel:
+    if model.model is None:
+        raise ValueError("The model is already quantized.")
+    with Instrumentation("quantize_taxonomy_model") as metrics:
+        with metrics.stage("conversion", unit="models") as stage:
+            tokens = models.num_tokens(*model.tokenization())
+            quantized = quantize(model.model, tf.TensorSpec((None, None, tokens), tf.int64), mode)
+            stage.items += 1
+        sequence_map, frequency = _read_inputs(metrics, sequences, frequency_table)
+        float_model = models.SetBERTTaxonomyModel(model.model, model.manifest)
+        # Everything inference needs from the float model is recorded, since it is not stored
+        manifest = copy.deepcopy(model.manifest)
+        sequence_length, kmer, kmer_stride = model.tokenization()
+        manifest.config["model"] = {
+            **manifest.config.get("model", {}),
+            "sequence_length": sequence_length,
+            "kmer": kmer,
+            "kmer_stride": kmer_stride,
+            "embed_dim": _embedding_width(model)
+        }
+        manifest.config["taxonomy_tree"] = json.loads(model.model.taxonomy_tree.serialize())
+        quantized_model = models.SetBERTTaxonomyModel(None, manifest, quantized)
+        with metrics.stage("evaluation", unit="models") as stage:
+            float_taxonomy, float_throughput = _held_out_taxonomy(
+                float_model, sequence_map, frequency, batch_size, subsample_size, seed, confidence)
+            quantized_taxonomy, quantized_throughput = _held_out_taxonomy(
+                quantized_model, sequence_map, frequency, batch_size, subsample_size, seed, confidence)
+            stage.items += 2
+        report = {
+            "mode": mode,
+            "float_bytes": int(sum(w.numpy().nbytes for w in model.model.weights)),
+            "quantized_bytes": len(quantized),
+            "held_out_features": len(float_taxonomy),
+            "agreement": float(np.mean([
+                quantized_taxonomy.get(sequence_id) == taxon for sequence_id, taxon in float_taxonomy.items()
+            ])) if len(float_taxonomy) > 0 else float("nan"),
+            "float_sets_per_second": round(float_throughput, 3),
+            "quantized_sets_per_second": round(quantized_throughput, 3)
+        }
+        if reference_taxonomy is not None:
+            report["float_accuracy"] = _accuracy(float_taxonomy, reference_taxonomy)
+            report["quantized_accuracy"] = _accuracy(quantized_taxonomy, reference_taxonomy)
+            report["accuracy_difference"] = report["quantized_accuracy"] - report["float_accuracy"]
+        quantized_model.manifest.config["quantization"] = report
+        metrics.event("quantization", **report)
+    return quantized_model
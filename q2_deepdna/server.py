@@ -0,0 +1,184 @@
+"""
+A long-running local inference server that keeps taxonomy models resident.
+
+Requests are JSON lines sent over a Unix socket and are shaped like `classify_taxonomy`. Subsample
+sets from concurrent requests are micro-batched into shared inference calls.
+
+Usage:
+    python -m q2_deepdna.server --model silva=setbert_taxonomy_model.qza [--socket PATH]
+"""
+import argparse
+from concurrent.futures import Future
+import json
+import numpy as np
+import os
+import pandas as pd
+import queue
+import socket
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from . import models
+from .classify import DEFAULT_SERVER_SOCKET, TaxonomyStatistics, _accumulate, _encode, _subsample
+from ._quantize import taxonomy_predictor
+
+
+class _Batcher(threading.Thread):
+    """
+    Collects subsample sets submitted for a single model and runs them through shared
+    inference calls.
+    """
+    def __init__(self, model: models.SetBERTTaxonomyModel, batch_size: int, max_sets: int, max_wait: float):
+        super().__init__(daemon=True)
+        self.model = model
+        self.predictor = taxonomy_predictor(model)
+        self.batch_size = batch_size
+        self.max_sets = max_sets
+        self.max_wait = max_wait
+        self.queue: "queue.Queue[Tuple[np.ndarray, Future]]" = queue.Queue()
+
+    def submit(self, x: np.ndarray) -> Future:
+        future = Future()
+        self.queue.put((x, future))
+        return future
+
+    def _collect(self) -> List[Tuple[np.ndarray, Future]]:
+        pending = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while sum(len(x) for x, _ in pending) < self.max_sets:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return pending
+
+    def run(self):
+        while True:
+            # Sets can only share an inference call if they have the same shape
+            groups: Dict[Tuple[int, ...], List[Tuple[np.ndarray, Future]]] = {}
+            for x, future in self._collect():
+                groups.setdefault(x.shape[1:], []).append((x, future))
+            for items in groups.values():
+                try:
+                    x = np.concatenate([x for x, _ in items])
+                    predictions = self.predictor.predict(x, batch_size=self.batch_size, verbose=0)
+                    predictions = predictions.reshape((len(x), -1))
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                offset = 0
+                for x, future in items:
+                    future.set_result(predictions[offset:offset+len(x)].flatten())
+                    offset += len(x)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: "InferenceServer"
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"statistics": self.server.classify(json.loads(line))}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            # Confidence sums accumulate as NumPy floats
+            self.wfile.write((json.dumps(response, default=float) + '\n').encode())
+            self.wfile.flush()
+
+
+def _remove_stale_socket(socket_path: str):
+    """
+    Remove a socket left behind by a server that is no longer running, refusing to replace one
+    that is still accepting connections.
+    """
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+            return
+    raise RuntimeError(f"An inference server is already listening on {socket_path}.")
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str,
+        taxonomy_models: Dict[str, models.SetBERTTaxonomyModel],
+        batch_size: Optional[int] = None,
+        max_sets: int = 16,
+        max_wait: float = 0.05
+    ):
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        # By default, all the sets collected for an inference call run as a single batch
+        self.batchers = {
+            name: _Batcher(model, batch_size or max_sets, max_sets, max_wait)
+            for name, model in taxonomy_models.items()
+        }
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    def classify(self, request: dict) -> TaxonomyStatistics:
+        if request["model"] not in self.batchers:
+            raise KeyError(f"Unknown model: {request['model']}. Available: {list(self.batchers)}")
+        batcher = self.batchers[request["model"]]
+        sequence_length, kmer, kmer_stride = batcher.model.tokenization()
+        seed = request.get("seed")
+        rng = np.random.default_rng(seed)
+        pending = []
+        for i, (sample_id, abundances) in enumerate(request["samples"].items()):
+            if seed is not None:
+                # Derive each sample's generator from its position, as classify_taxonomy does
+                rng = np.random.default_rng([seed, i])
+            abundances = pd.Series(abundances, dtype=int)
+            abundances = abundances[abundances > 0]
+            if len(abundances) == 0:
+                continue
+            sequence_ids = _subsample(abundances, request["subsample_size"], rng)
+            x = _encode(
+                sequence_ids,
+                request["sequences"],
+                request["subsample_size"],
+                sequence_length,
+                kmer,
+                rng,
+                kmer_stride)
+            pending.append((sequence_ids, batcher.submit(x)))
+        statistics: TaxonomyStatistics = {}
+        for sequence_ids, future in pending:
+            _accumulate(statistics, sequence_ids, future.result())
+        return statistics
+
+
+def main():
+    import qiime2
+    parser = argparse.ArgumentParser(description="Serve DeepDNA taxonomy models over a Unix socket.")
+    parser.add_argument("--model", action="append", required=True, metavar="NAME=PATH",
+                        help="A SetBERT taxonomy model artifact to keep resident (repeatable).")
+    parser.add_argument("--socket", default=DEFAULT_SERVER_SOCKET, help="The Unix socket to listen on.")
+    parser.add_argument("--batch-size", type=int, default=None, help="The batch size of each inference call. Defaults to --max-sets.")
+    parser.add_argument("--max-sets", type=int, default=16, help="The maximum number of subsample sets per inference call.")
+    parser.add_argument("--max-wait", type=float, default=0.05, help="Seconds to wait for more sets before running an inference call.")
+    args = parser.parse_args()
+    taxonomy_models = {}
+    for definition in args.model:
+        name, path = definition.split('=', 1)
+        taxonomy_models[name] = qiime2.Artifact.load(path).view(models.SetBERTTaxonomyModel)
+    with InferenceServer(args.socket, taxonomy_models, args.batch_size, args.max_sets, args.max_wait) as server:
+        print(f"Serving {list(taxonomy_models)} on {args.socket}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
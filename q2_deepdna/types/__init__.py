@@ -1,10 +1,13 @@
 from ._format import (
     DNAFASTADBFormat,
     TaxonomyDBFormat,
+    EncodedSequencesFormat,
     DeepDNASavedModelFormat,
     JSONFormat,
     CSVFormat,
     CSVDirectoryFormat,
+    TaxonomyStatisticsFormat,
+    TaxonomyStatisticsDirectoryFormat,
 )
 from ._type import (
     DeepDNAModel,
@@ -18,16 +21,21 @@ from ._type import (
     # SampleClassPrediction,
     SequenceDB,
     TaxonomyDB,
+    EncodedSequences,
+    TaxonomyStatistics,
 )
 
 __all__ = [
     # Formats
     "DNAFASTADBFormat",
     "TaxonomyDBFormat",
+    "EncodedSequencesFormat",
     "DeepDNASavedModelFormat",
     "JSONFormat",
     "CSVFormat",
     "CSVDirectoryFormat",
+    "TaxonomyStatisticsFormat",
+    "TaxonomyStatisticsDirectoryFormat",
 
     # Semantic types
     "DeepDNAModel",
@@ -41,5 +49,7 @@ __all__ = [
 
     # "SampleClassPrediction",
     "SequenceDB",
-    "TaxonomyDB"
+    "TaxonomyDB",
+    "EncodedSequences",
+    "TaxonomyStatistics"
 ]
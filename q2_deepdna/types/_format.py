@@ -1,16 +1,22 @@
 from dnadb import fasta, taxonomy
 from deepdna.nn.models import load_model
 import json
+import numpy as np
 import pandas as pd
-from qiime2.plugin import model
+from pathlib import Path
+from qiime2.plugin import model, ValidationError
+import shutil
 import tensorflow as tf
-from typing import Tuple
+from typing import List, Optional, Tuple, Union
 from ..models import (
     DeepDNAModel, DNABERTPretrainingModel, DeepDNAModelManifest,
     DNABERTNaiveTaxonomyModel, DNABERTBERTaxTaxonomyModel, DNABERTTopDownTaxonomyModel,
     SetBERTClassificationModel,SetBERTPretrainingModel, SetBERTTaxonomyModel
 )
+from .._encoded import EncodedSequences
+from .._lmdb import ReadOnlyFastaDb, ReadOnlyTaxonomyDb, copy_environment
 from .._registry import register_format
+from .._weights import read_weights, write_weights
 from ..plugin_setup import plugin, citations
 
 
@@ -32,6 +38,19 @@ class CSVFormat(model.TextFileFormat):
 
 CSVDirectoryFormat = model.SingleFileDirectoryFormat("CSVDirectoryFormat", "data.csv", CSVFormat)
 
+@register_format
+class TaxonomyStatisticsFormat(model.TextFileFormat):
+    HEADER = ["Feature ID", "Rank", "Taxon", "Confidence Sum", "Count"]
+
+    def _validate_(self, level):
+        with self.open() as f:
+            header = f.readline().rstrip('\n').split('\t')
+        if header != self.HEADER:
+            raise ValidationError(f"Expected header {self.HEADER}, found {header}.")
+
+TaxonomyStatisticsDirectoryFormat = register_format(model.SingleFileDirectoryFormat(
+    "TaxonomyStatisticsDirectoryFormat", "statistics.tsv", TaxonomyStatisticsFormat))
+
 @register_format
 class LMDBFormat(model.DirectoryFormat):
     data = model.File("data.mdb", format=_GenericBinaryFormat)
@@ -48,13 +67,38 @@ class TaxonomyDBFormat(LMDBFormat):
     ...
 
 
+@register_format
+class EncodedSequencesFormat(model.DirectoryFormat):
+    index = model.File("index.json", format=JSONFormat)
+    sequences = model.FileCollection(r"sequences-\d+\.npy", format=_GenericBinaryFormat)
+    lengths = model.FileCollection(r"lengths-\d+\.npy", format=_GenericBinaryFormat)
+
+    @sequences.set_path_maker
+    def sequences_path_maker(self, shard: int):
+        return f"sequences-{shard}.npy"
+
+    @lengths.set_path_maker
+    def lengths_path_maker(self, shard: int):
+        return f"lengths-{shard}.npy"
+
+
 @register_format
 class DeepDNASavedModelFormat(model.DirectoryFormat):
     manifest: model.File = model.File("manifest.json", format=JSONFormat)
-    keras_metadata_pure_tf = model.File("model/keras_metadata.pb", format=_GenericBinaryFormat)
-    saved_model_pure_tf = model.File("model/saved_model.pb", format=_GenericBinaryFormat)
-    variables_index = model.File("model/variables/variables.index", format=_GenericBinaryFormat)
-    variables_data = model.File("model/variables/variables.data-00000-of-00001", format=_GenericBinaryFormat)
+    # The float Keras model (every model except quantized ones)
+    keras_metadata_pure_tf = model.File("model/keras_metadata.pb", format=_GenericBinaryFormat, optional=True)
+    saved_model_pure_tf = model.File("model/saved_model.pb", format=_GenericBinaryFormat, optional=True)
+    variables_index = model.File("model/variables/variables.index", format=_GenericBinaryFormat, optional=True)
+    variables_data = model.File("model/variables/variables.data-00000-of-00001", format=_GenericBinaryFormat, optional=True)
+    # TFLite flatbuffer of a quantized model (quantized models only), which replaces the float model
+    quantized_model = model.File("quantized/model.tflite", format=_GenericBinaryFormat, optional=True)
+    # Weights of the early-exit heads (early-exit models only)
+    exit_heads_index = model.File("early_exit/index.json", format=JSONFormat, optional=True)
+    exit_heads_data = model.File("early_exit/data.bin", format=_GenericBinaryFormat, optional=True)
+
+    def _validate_(self, level):
+        if not (self.path / "model" / "saved_model.pb").exists() and not (self.path / "quantized" / "model.tflite").exists():
+            raise ValidationError("The artifact contains neither a SavedModel nor a quantized TFLite model.")
 
 
 # File Format Transformers Registry ----------------------------------------------------------------
@@ -63,6 +107,8 @@ class DeepDNASavedModelFormat(model.DirectoryFormat):
 def _1(data: fasta.FastaDb) -> DNAFASTADBFormat:
     ff = DNAFASTADBFormat()
     ff.path.mkdir(parents=True, exist_ok=True)
+    if copy_environment(data, ff.path) is not None:
+        return ff
     with fasta.FastaDbFactory(ff.path) as factory:
         factory.uuid = data.uuid
         factory.write_entries(iter(data))
@@ -70,12 +116,14 @@ def _1(data: fasta.FastaDb) -> DNAFASTADBFormat:
 
 @plugin.register_transformer
 def _2(ff: DNAFASTADBFormat) -> fasta.FastaDb:
-    return fasta.FastaDb(ff.path)
+    return ReadOnlyFastaDb(ff.path)
 
 @plugin.register_transformer
 def _3(data: taxonomy.TaxonomyDb) -> TaxonomyDBFormat:
     ff = TaxonomyDBFormat()
     ff.path.mkdir(parents=True, exist_ok=True)
+    if copy_environment(data, ff.path) is not None:
+        return ff
     assert data.fasta_db is not None, "Taxonomy DB must have a corresponding FASTA DB."
     with taxonomy.TaxonomyDbFactory(ff.path, data.fasta_db, depth=data.tree.depth) as factory:
         factory.uuid = data.uuid
@@ -84,7 +132,11 @@ def _3(data: taxonomy.TaxonomyDb) -> TaxonomyDBFormat:
 
 @plugin.register_transformer
 def _4(ff: TaxonomyDBFormat) -> taxonomy.TaxonomyDb:
-    return taxonomy.TaxonomyDb(ff.path)
+    return ReadOnlyTaxonomyDb(ff.path)
+
+@plugin.register_transformer
+def _23(ff: EncodedSequencesFormat) -> EncodedSequences:
+    return EncodedSequences(ff.path)
 
 @plugin.register_transformer
 def _5(data: dict) -> JSONFormat:
@@ -119,13 +171,35 @@ def _save_model(data: DeepDNAModel) -> DeepDNASavedModelFormat:
     ff = DeepDNASavedModelFormat()
     ff.path.mkdir(parents=True, exist_ok=True)
     ff.manifest.write_data(data.manifest.to_dict(), dict) # type: ignore
-    data.model.save(ff.path / "model")
+    if data.model is not None:
+        data.model.save(ff.path / "model")
+    if data.quantized is not None:
+        (ff.path / "quantized").mkdir()
+        if isinstance(data.quantized, bytes):
+            (ff.path / "quantized" / "model.tflite").write_bytes(data.quantized)
+        else:
+            shutil.copyfile(data.quantized, ff.path / "quantized" / "model.tflite")
+    if data.exit_heads is not None:
+        write_weights(ff.path / "early_exit", data.exit_heads)
     return ff
 
-def _load_model(ff: DeepDNASavedModelFormat) -> Tuple[tf.keras.Model, DeepDNAModelManifest]:
-    model, manifest = load_model(ff.path / "model"), DeepDNAModelManifest(**(ff.manifest.view(dict) or {})) # type: ignore
-    print("Loaded model:", model)
-    return model, manifest
+def _load_model(
+    ff: DeepDNASavedModelFormat
+) -> Tuple[Optional[tf.keras.Model], DeepDNAModelManifest, Optional[Union[bytes, Path]], Optional[List[np.ndarray]]]:
+    manifest = DeepDNAModelManifest(**(ff.manifest.view(dict) or {})) # type: ignore
+    # Quantized models are stored without their float model
+    model = None
+    if (ff.path / "model" / "saved_model.pb").exists():
+        model = load_model(ff.path / "model")
+        print("Loaded model:", model)
+    # The flatbuffer is kept as a path so the interpreter maps it rather than reading a copy
+    quantized = None
+    if (ff.path / "quantized" / "model.tflite").exists():
+        quantized = ff.path / "quantized" / "model.tflite"
+    exit_heads = None
+    if (ff.path / "early_exit" / "index.json").exists():
+        exit_heads = read_weights(ff.path / "early_exit")
+    return model, manifest, quantized, exit_heads
 
 # DNABERT Pre-training Model
 
@@ -1,6 +1,9 @@
 from qiime2.plugin import SemanticType
 from q2_types.feature_data import FeatureData
-from ._format import CSVFormat, CSVDirectoryFormat, DNAFASTADBFormat, DeepDNASavedModelFormat, TaxonomyDBFormat
+from ._format import (
+    CSVFormat, CSVDirectoryFormat, DNAFASTADBFormat, DeepDNASavedModelFormat, EncodedSequencesFormat,
+    TaxonomyDBFormat, TaxonomyStatisticsDirectoryFormat
+)
 from ..plugin_setup import plugin
 
 # Some notes for myself because these are confusing:
@@ -25,6 +28,18 @@ plugin.register_semantic_type_to_format(FeatureData[TaxonomyDB], TaxonomyDBForma
 
 plugin.register_artifact_class(FeatureData[SampleClassPrediction], directory_format=CSVDirectoryFormat, description="")
 
+# Encoded sequence formats -------------------------------------------------------------------------
+EncodedSequences = SemanticType("EncodedSequences", variant_of=FeatureData.field["type"])
+
+plugin.register_semantic_types(EncodedSequences)
+plugin.register_semantic_type_to_format(FeatureData[EncodedSequences], EncodedSequencesFormat) # type: ignore
+
+# Classification formats ---------------------------------------------------------------------------
+TaxonomyStatistics = SemanticType("TaxonomyStatistics", variant_of=FeatureData.field["type"])
+
+plugin.register_semantic_types(TaxonomyStatistics)
+plugin.register_semantic_type_to_format(FeatureData[TaxonomyStatistics], TaxonomyStatisticsDirectoryFormat) # type: ignore
+
 # Model formats ------------------------------------------------------------------------------------
 
 # Generic DeepDNAModel
@@ -13,7 +13,9 @@ setup(
     url="https://github.com/DLii-Research/q2-deepdna",
     entry_points={
         "qiime2.plugins":
-        ["q2-deepdna=q2_deepdna.plugin_setup:plugin"]
+        ["q2-deepdna=q2_deepdna.plugin_setup:plugin"],
+        "console_scripts":
+        ["q2-deepdna-server=q2_deepdna.server:main"]
     },
     package_data={
         "q2_deepdna": ["citations.bib"],